@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
+import startup_profile
+
 import datetime
 import re
-import numpy as np 
+from math import nan
 
 from daemon import SimpleFactory, SimpleProtocol, catch
 
@@ -135,7 +137,7 @@ class HP33120AProtocol(SimpleProtocol):
     @catch
     def connectionLost(self, reason):
         self.object['hw_connected'] = 0
-        self.object['out_load'] = np.nan
+        self.object['out_load'] = nan
         self.object['volt_unit'] = 'none'
         SimpleProtocol.connectionLost(self, reason)
         
@@ -234,8 +236,8 @@ if __name__ == '__main__':
     obj = {
         'hw_connected': 0,
         'addr': options.addr,
-        'out_load':np.nan,
-        'volt_offs':np.nan,
+        'out_load':nan,
+        'volt_offs':nan,
         'volt_unit':'none',
         }
     # Factories for daemon and hardware connections
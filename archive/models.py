@@ -29,3 +29,44 @@ class MonitorStatus(models.Model):
 
     def __str__(self):
         return "%s: %s" % (self.time, Truncator(self.status).chars(40))
+
+class MonitorValue(models.Model):
+    time = models.DateTimeField(primary_key=True) # There is no primary key in this table
+    client = models.TextField()
+    key = models.TextField()
+    value = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'monitor_values'
+        app_label = 'ccdlab'
+
+    def __str__(self):
+        return "%s: %s.%s = %g" % (self.time, self.client, self.key, self.value)
+
+class MonitorRollup(models.Model):
+    time = models.DateTimeField(primary_key=True) # Start of the bucket, actual primary key is (client, key, time)
+    client = models.TextField()
+    key = models.TextField()
+    vmin = models.FloatField(blank=True, null=True)
+    vmean = models.FloatField(blank=True, null=True)
+    vmax = models.FloatField(blank=True, null=True)
+    n = models.IntegerField()
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return "%s: %s.%s = %g .. %g .. %g" % (self.time, self.client, self.key, self.vmin, self.vmean, self.vmax)
+
+class MonitorRollupMinute(MonitorRollup):
+    class Meta:
+        managed = False
+        db_table = 'monitor_rollup_1m'
+        app_label = 'ccdlab'
+
+class MonitorRollupHour(MonitorRollup):
+    class Meta:
+        managed = False
+        db_table = 'monitor_rollup_1h'
+        app_label = 'ccdlab'
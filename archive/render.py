@@ -0,0 +1,137 @@
+"""
+Rendering of status plots, either in-process or in the pool of warm worker processes, so that CPU-bound
+matplotlib work does not block the web server threads and scales with the number of cores
+"""
+import datetime
+import io
+import multiprocessing
+import threading
+
+from django.conf import settings
+
+import numpy as np
+
+# Figures and canvases of worker process, keyed by the size, re-used between the plots.
+# Rendering in the web server process may run in several threads at once, so every plot gets its own figure there
+_figures = {}
+_worker = False
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _figure(width, height):
+    """Blank figure and its canvas of given size"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    from matplotlib.figure import Figure
+
+    def new():
+        fig = Figure(facecolor='white', dpi=72, figsize=(width*1.0/72, height*1.0/72), tight_layout=True)
+        return fig, FigureCanvas(fig)
+
+    if not _worker:
+        return new()
+
+    key = (int(width), int(height))
+
+    if key not in _figures:
+        _figures[key] = new()
+
+    fig,canvas = _figures[key]
+    fig.clear()
+
+    return fig, canvas
+
+def _is_number(s):
+    try:
+        float(s)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+def render_status(times, values, mins, maxs, labels, time1, time2, width=1000.0, height=500.0, title=None,
+                  xlabel="Time, UT", ylabel=None, ylog=False, grid=True, mark=None):
+    """Plot the lists of times and values, with optional min/max ranges, and return the PNG bytes"""
+    from matplotlib.dates import DateFormatter
+    from matplotlib.ticker import MaxNLocator, NullLocator
+
+    fig,canvas = _figure(width, height)
+    ax = fig.add_subplot(111)
+    ax.autoscale()
+
+    for _,value in enumerate(values):
+        if np.any(np.array(value) != None):
+            if len(value) and _is_number(value[0]):
+                value = np.double(['nan' if _ == 'None' else _ for _ in value])
+
+            lines = ax.plot(times[_], value, '-', label=labels[_])
+
+            if mins is not None and len(value):
+                # Range of values within every rollup or time bucket
+                ax.fill_between(times[_], np.array(mins[_], dtype=float), np.array(maxs[_], dtype=float), color=lines[0].get_color(), alpha=0.3, lw=0)
+
+    # if time and has_data: # It is failing if no data are plotted
+    if (time2 - time1).total_seconds() < 2*24*3600:
+        ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
+    elif (time2 - time1).total_seconds() > 3*24*3600:
+        ax.xaxis.set_major_formatter(DateFormatter('%Y.%m.%d'))
+    else:
+        ax.xaxis.set_major_formatter(DateFormatter('%Y.%m.%d %H:%M:%S'))
+
+    fig.autofmt_xdate()
+
+    if mark is not None:
+        ax.axvline(mark, color='red', ls='--', alpha=1.0)
+
+    ax.set_xlim(time1, time2)
+
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.grid(grid)
+
+    if len(labels) > 1:
+        ax.legend(frameon=True, loc=2, framealpha=0.99)
+
+    if ylog:
+        ax.set_yscale('log', nonpositive='clip')
+
+        # Try to fix the ticks if the data span is too small
+        axis = ax.get_yaxis()
+        if np.ptp(np.log10(axis.get_data_interval())) < 1:
+            axis.set_major_locator(MaxNLocator())
+            axis.set_minor_locator(NullLocator())
+
+    # 10% margins on both axes
+    ax.margins(0.03, 0.03)
+
+    s = io.BytesIO()
+    canvas.print_png(s)
+
+    return s.getvalue()
+
+def _init_worker():
+    """Import matplotlib and fill its font and layout caches in the fresh worker process"""
+    global _worker
+    _worker = True
+
+    time2 = datetime.datetime.utcnow()
+    time1 = time2 - datetime.timedelta(hours=1)
+
+    render_status([[time1, time2]], [[0, 1]], None, None, ['warmup'], time1, time2)
+
+def _get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # Forking the multi-threaded web server process is unsafe, so the workers are started afresh
+            _pool = multiprocessing.get_context('spawn').Pool(settings.RENDER_PROCESSES, initializer=_init_worker)
+
+    return _pool
+
+def render(*args, **kwargs):
+    """Render the status plot with render_status(), in the worker pool if RENDER_PROCESSES setting is positive"""
+    if getattr(settings, 'RENDER_PROCESSES', 0) > 0:
+        return _get_pool().apply(render_status, args, kwargs)
+    else:
+        return render_status(*args, **kwargs)
@@ -0,0 +1,164 @@
+import ast
+import re
+
+import numpy as np
+
+def make_grid(time1, time2, npoints=1000):
+    """Common time grid of npoints bucket mid-times covering the interval"""
+    step = max((time2 - time1).total_seconds()/max(npoints, 1), 1e-3)
+
+    return np.datetime64(time1, 'us') + ((np.arange(npoints) + 0.5)*step*1e6).astype('timedelta64[us]')
+
+def _seconds(times, time0):
+    return (np.asarray(times, dtype='datetime64[us]') - time0).astype('i8')/1e6
+
+def resample(times, values, grid, method='linear'):
+    """
+    Resample the values onto the time grid. Methods are 'nearest' (closest sample not farther than grid step),
+    'linear' (interpolation between samples) and 'mean' (average of the samples within grid step around every point).
+    Grid points with no data become NaNs
+    """
+    grid = np.asarray(grid, dtype='datetime64[us]')
+    result = np.full(len(grid), np.nan)
+
+    if not len(grid):
+        return result
+
+    g = _seconds(grid, grid[0])
+    x = _seconds(times, grid[0])
+    y = np.asarray(values, dtype=float).reshape(-1)
+
+    # Missing values are just skipped
+    good = np.isfinite(y)
+    x,y = x[good],y[good]
+
+    if not len(x):
+        return result
+
+    step = g[1] - g[0] if len(g) > 1 else np.inf
+
+    if method == 'linear':
+        result = np.interp(g, x, y, left=np.nan, right=np.nan)
+    elif method == 'nearest':
+        idx = np.searchsorted(x, g)
+        left = np.clip(idx - 1, 0, len(x) - 1)
+        right = np.clip(idx, 0, len(x) - 1)
+        idx = np.where(np.abs(x[right] - g) < np.abs(x[left] - g), right, left)
+
+        result = y[idx]
+        result[np.abs(x[idx] - g) > step] = np.nan
+    elif method == 'mean':
+        bins = np.floor((x - g[0])/step + 0.5).astype(int) if len(g) > 1 else np.zeros(len(x), dtype=int)
+        idx = (bins >= 0) & (bins < len(g))
+
+        sums = np.bincount(bins[idx], weights=y[idx], minlength=len(g))
+        counts = np.bincount(bins[idx], minlength=len(g))
+
+        result[counts > 0] = sums[counts > 0]/counts[counts > 0]
+    else:
+        raise ValueError("Unknown resampling method: %s" % method)
+
+    return result
+
+def break_gaps(times, series, max_gap):
+    """
+    Insert NaN points into the middle of the gaps between consecutive times longer than max_gap seconds, so that
+    the lines are not drawn across the periods with no data. Returns the new times and the list of float arrays
+    for every array in series
+    """
+    times = np.asarray(times, dtype='datetime64[us]')
+    series = [np.asarray(_, dtype=float) for _ in series]
+
+    if len(times) < 2:
+        return times, series
+
+    dt = np.diff(times).astype('i8')/1e6
+    idx = np.where(dt > max_gap)[0]
+
+    if not len(idx):
+        return times, series
+
+    mid = times[idx] + (np.diff(times)[idx] // 2)
+
+    return np.insert(times, idx + 1, mid), [np.insert(_, idx + 1, np.nan) for _ in series]
+
+class Expression:
+    """
+    Arithmetic expression over client.key variables given in curly braces, e.g. {plh120-p.VoltageActual}*{plh120-p.CurrentActual}.
+    Plain client.key string is the expression with single variable. It is validated to contain only numbers,
+    arithmetic operators and a few numpy functions, and is evaluated over numpy arrays
+    """
+    _functions = {'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+                  'sin': np.sin, 'cos': np.cos, 'tan': np.tan}
+
+    _nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load,
+              ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd, ast.Constant)
+
+    def __init__(self, string):
+        self.string = string
+        self.variables = []
+
+        def variable(m):
+            name = m.group(1).strip()
+            if name not in self.variables:
+                self.variables.append(name)
+            return 'v%d' % self.variables.index(name)
+
+        # Plain client.key is the same as {client.key}
+        code = re.sub(r'\{([^{}]+)\}', variable, string if '{' in string else '{%s}' % string)
+
+        for name in self.variables:
+            if '.' not in name:
+                raise ValueError("Variable should be in client.key form: %s" % name)
+
+        try:
+            tree = ast.parse(code, mode='eval')
+        except SyntaxError:
+            raise ValueError("Cannot parse expression: %s" % string)
+
+        names = ['v%d' % _ for _ in range(len(self.variables))]
+
+        for node in ast.walk(tree):
+            if not isinstance(node, self._nodes):
+                raise ValueError("Unsupported element %s in expression: %s" % (node.__class__.__name__, string))
+            if isinstance(node, ast.Constant):
+                if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+                    raise ValueError("Only numerical constants are allowed in expression: %s" % string)
+                # Float arithmetics, so that e.g. 9**9**9 overflows instead of computing huge integer
+                node.value = float(node.value)
+            if isinstance(node, ast.Name) and node.id not in names and node.id not in self._functions:
+                raise ValueError("Unknown name %s in expression: %s" % (node.id, string))
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.func.id not in self._functions or node.keywords):
+                raise ValueError("Only simple calls of %s are allowed in expression: %s" % (", ".join(self._functions), string))
+
+        self.code = compile(tree, '<expression>', 'eval')
+
+        # Plain client.key, with or without braces and parentheses
+        self._variable = isinstance(tree.body, ast.Name) and tree.body.id == 'v0'
+
+        # Label for plots and data columns - variable name, or the expression itself
+        self.label = self.variables[0] if self._variable else string
+
+    def is_variable(self):
+        """Whether the expression is just a single variable"""
+        return self._variable
+
+    def evaluate(self, data, size=None):
+        """Evaluate the expression over the dictionary of arrays for all its variables"""
+        namespace = dict(self._functions)
+        for i,name in enumerate(self.variables):
+            namespace['v%d' % i] = data[name]
+
+        try:
+            with np.errstate(all='ignore'):
+                result = eval(self.code, {'__builtins__': {}}, namespace)
+        except ArithmeticError:
+            # Overflow or division by zero in constant sub-expressions
+            result = np.nan
+
+        result = np.asarray(result, dtype=float)
+        if size is not None and result.ndim == 0:
+            # Constant expression
+            result = np.full(size, result)
+
+        return result
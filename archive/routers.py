@@ -1,6 +1,48 @@
+import time
+import logging
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
 class ArchiveRouter(object):
+    """
+    Routes ccdlab models to the observational database. Reads go to 'ccdlab_replica' database, if it is defined
+    in settings, so that heavy archive queries do not compete with the inserts from the monitor. If the replica
+    is not reachable, reads fall back to the primary, and the replica is re-tried after REPLICA_RETRY seconds
+    """
+    replica = 'ccdlab_replica'
+
+    # Time of the last failed connection to the replica
+    _replica_failed = None
+
+    def replica_available(self):
+        if self.replica not in settings.DATABASES:
+            return False
+
+        if self._replica_failed is not None and time.time() - self._replica_failed < getattr(settings, 'REPLICA_RETRY', 60):
+            return False
+
+        connection = connections[self.replica]
+
+        try:
+            # Persistent connection may be dead after the replica restart
+            if connection.connection is not None and not connection.is_usable():
+                connection.close()
+
+            connection.ensure_connection()
+            ArchiveRouter._replica_failed = None
+            return True
+        except Exception as e:
+            logger.warning("Replica database not available, falling back to primary: %s", e)
+            ArchiveRouter._replica_failed = time.time()
+            return False
+
     def db_for_read(self, model, **hints):
         if model._meta.app_label == 'ccdlab':
+            if self.replica_available():
+                return self.replica
             return 'ccdlab'
         return 'default'
 
@@ -19,7 +61,7 @@ class ArchiveRouter(object):
         return False
 
     def allow_syncdb(self, db, model):
-        if db == 'ccdlab' or model._meta.app_label == "ccdlab":
+        if db in ['ccdlab', self.replica] or model._meta.app_label == "ccdlab":
             return False # we're not using syncdb on our legacy database
         else: # but all other models/databases are fine
             return True
@@ -111,11 +111,52 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+        'CONN_MAX_AGE': 600,             # Keep the connection open between requests for this number of seconds
+    },
+    # Optional read-only streaming replica of ccdlab db, used by the archive views instead of the primary one.
+    # Reads fall back to the primary if it is not reachable within connect_timeout seconds.
+    # Replication lag delays the data in the archive, so STATUS_CACHE_HORIZON below should exceed it,
+    # otherwise the plots for recent past may be cached for STATUS_CACHE_TTL with some data missing
+    # 'ccdlab_replica': {
+    #     'ENGINE': 'django.db.backends.postgresql_psycopg2',
+    #     'NAME': 'ccdlab',
+    #     'HOST': 'replica.host',
+    #     'PORT': '',
+    #     'CONN_MAX_AGE': 600,
+    #     'OPTIONS': {'connect_timeout': 3},
+    # },
 }
 
+# Seconds to wait before trying again the replica database after failed connection
+REPLICA_RETRY = 60
+
 DATABASE_ROUTERS = ['archive.routers.ArchiveRouter']
 
+# Whether to plot the status values from narrow monitor_values table instead of JSONB snapshots.
+# The table is populated by the monitor, and may be back-filled using `db_admin.py backfill`
+STATUS_VALUES = False
+
+# Whether to use per-minute and per-hour rollups for long time ranges, so that roughly one point per pixel is plotted.
+# The rollup tables should be updated periodically using `db_admin.py rollup --loop=60`
+STATUS_ROLLUPS = False
+
+# Cache for status plots. Plots for time ranges ending earlier than STATUS_CACHE_HORIZON seconds ago are kept for
+# STATUS_CACHE_TTL seconds, others - until the next status snapshot, which the monitor stores every STATUS_DB_INTERVAL
+# seconds (its db_status_interval). The horizon should cover the delays of the rollup job and of the replica, if any
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
+
+STATUS_CACHE_TTL = 7*24*3600
+STATUS_CACHE_HORIZON = 2*3600
+STATUS_DB_INTERVAL = 60
+
+# Number of worker processes rendering the plots, keeping warm matplotlib figures. Zero means rendering in the web server process
+RENDER_PROCESSES = 0
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
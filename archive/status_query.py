@@ -0,0 +1,29 @@
+from django.db import connections, router
+
+import numpy as np
+
+try:
+    from models import MonitorStatus
+except ImportError:
+    from . models import MonitorStatus
+
+from status_export import buckets_query
+
+def status_buckets(variables, time1, time2, nbuckets=1000):
+    """
+    Minimal, mean and maximal values of client.key variables from monitor_status snapshots, aggregated by Postgres
+    into given number of equal time buckets. Returns numpy arrays of bucket mid-times and of (nvariables, nbuckets)
+    shaped mins, means and maxs, with NaNs for the buckets having no numerical values. Empty buckets are skipped
+    """
+    step = max((time2 - time1).total_seconds()/max(nbuckets, 1), 1e-3)
+
+    with connections[router.db_for_read(MonitorStatus)].cursor() as cur:
+        cur.execute(buckets_query(variables), (time1, step, time1, time2))
+        rows = cur.fetchall()
+
+    # NULLs become NaNs
+    data = np.array(rows, dtype=float).reshape(-1, 1 + 3*len(variables))
+
+    times = np.datetime64(time1, 'us') + ((data[:,0] + 0.5)*step*1e6).astype('timedelta64[us]')
+
+    return times, data[:,1::3].T, data[:,2::3].T, data[:,3::3].T
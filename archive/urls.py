@@ -15,11 +15,15 @@ urlpatterns = [
     url(r'^$', views.current, name="current"),
 
     # Log view
+    url(r'^logs/export/?$', views.logs_export, name='logs_export'),
     url(r'^logs(/(?P<source>[a-zA-Z0-9_\-/.,]+)?)?$', views.logs_list, name='logs'),
 
     # Status
     url(r'^status/?$', views_status.status, name='status'),
-    url(r'^status/plots/(?P<params>[a-zA-Z0-9_\-/.,]+)/?$', views_status.status_plot, name='status_plot'),
+    url(r'^status/plots/(?P<params>[a-zA-Z0-9_\-/.,{}()*+ ]+)/?$', views_status.status_plot, name='status_plot'),
+    url(r'^status/data/(?P<params>[a-zA-Z0-9_\-/.,{}()*+ ]+)/?$', views_status.status_data, name='status_data'),
+    url(r'^status/dump/?$', views.status_dump, name='status_dump'),
+    url(r'^status/export/(?P<params>[a-zA-Z0-9_\-.,]+)/?$', views_status.status_export, name='status_export'),
 
     # Robots
     url(r'^robots.txt$', lambda r: HttpResponse("User-agent: *\nDisallow: /\n", content_type="text/plain")),
@@ -1,5 +1,10 @@
 from django.db import connections, transaction
+from django.http import StreamingHttpResponse
 import posixpath
+import datetime
+import json
+import csv
+import zlib
 
 from django.contrib.auth.decorators import permission_required, user_passes_test, PermissionDenied
 
@@ -66,3 +71,79 @@ def assert_permission(request, perm):
 def assert_is_staff(request):
     if not request.user.is_staff:
         raise PermissionDenied
+
+def parse_date(string):
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y.%m.%d %H:%M:%S', '%Y.%m.%d']:
+        try:
+            return datetime.datetime.strptime(string.strip(), fmt)
+        except ValueError:
+            pass
+
+    return None
+
+def _json_default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+class Echo:
+    """File-like object returning what is written to it, for the streaming CSV writer"""
+    def write(self, value):
+        return value
+
+def atomic_iterator(queryset):
+    """
+    Iterate over the queryset using server-side cursor inside the transaction. Outside of it, Django would use
+    WITH HOLD cursor, which the database materializes in full
+    """
+    with transaction.atomic(using=queryset.db):
+        for row in queryset.iterator():
+            yield row
+
+def streaming_export(rows, columns, fmt='ndjson', compress=False, filename='export', batch=1000):
+    """
+    Streaming response with the rows (e.g. from atomic_iterator(), or any other generator) as newline-delimited
+    JSON objects or CSV lines, optionally gzip-compressed on the fly. Memory usage does not depend on the number of rows
+    """
+    if fmt == 'csv':
+        writer = csv.writer(Echo())
+        def line(row):
+            # Nested values, like status snapshots, go as JSON strings
+            return writer.writerow([json.dumps(_) if isinstance(_, (dict, list)) else
+                                    _.isoformat() if hasattr(_, 'isoformat') else _ for _ in row])
+        header = [writer.writerow(columns)]
+    else:
+        def line(row):
+            return json.dumps(dict(zip(columns, row)), default=_json_default) + '\n'
+        header = []
+
+    def chunks():
+        lines = header
+        for row in rows:
+            lines.append(line(row))
+            if len(lines) >= batch:
+                yield ''.join(lines).encode('utf-8')
+                lines = []
+        if lines:
+            yield ''.join(lines).encode('utf-8')
+
+    def gzipped(chunks):
+        # wbits=31 gives gzip container
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = z.compress(chunk)
+            if data:
+                yield data
+        yield z.flush()
+
+    filename += '.csv' if fmt == 'csv' else '.ndjson'
+
+    if compress:
+        response = StreamingHttpResponse(gzipped(chunks()), content_type='application/gzip')
+        filename += '.gz'
+    else:
+        response = StreamingHttpResponse(chunks(), content_type='text/csv' if fmt == 'csv' else 'application/x-ndjson')
+
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+
+    return response
@@ -1,15 +1,20 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.template.response import TemplateResponse
 from django.db.models import Avg, Min, Max, StdDev
+from django.db import connections, router
+from django.core.cache import cache
+from django.utils.http import urlencode
 
 try:
     from models import Log, MonitorStatus
-    from utils import permission_required_or_403
+    from utils import permission_required_or_403, parse_date, streaming_export, atomic_iterator
+    from views_status import status_time_range
 except:
     from . models import Log, MonitorStatus
-    from . utils import permission_required_or_403
+    from . utils import permission_required_or_403, parse_date, streaming_export, atomic_iterator
+    from . views_status import status_time_range
 
-import datetime, re
+import datetime, re, time
 from db import DB
 
 def index(request):
@@ -25,16 +30,150 @@ def current(request):
 def monitor(request):
     return TemplateResponse(request, 'monitor.html', context={})
 
+# Seconds after which the list of log sources is re-built from scratch, dropping the sources not present anymore
+_log_sources_ttl = 3600
+
+def log_sources():
+    """List of distinct log sources, cached and updated incrementally with the sources of newly added messages"""
+    cached = cache.get('log_sources')
+
+    with connections[router.db_for_read(Log)].cursor() as cur:
+        if cached is None or len(cached) < 3 or time.time() - cached[2] > _log_sources_ttl:
+            # Loose index scan over (source, time, id) index, jumping from one source to the next
+            cur.execute('''
+            WITH RECURSIVE s AS (
+                 SELECT min(source) AS source FROM log
+                 UNION ALL
+                 SELECT (SELECT min(source) FROM log WHERE source > s.source) FROM s WHERE s.source IS NOT NULL
+            ) SELECT source FROM s WHERE source IS NOT NULL
+            ''')
+            sources = set([_[0] for _ in cur.fetchall()])
+            cur.execute('SELECT max(id) FROM log')
+            last_id = cur.fetchone()[0] or 0
+            created = time.time()
+        else:
+            sources,last_id,created = cached
+            cur.execute('SELECT DISTINCT source FROM log WHERE id > %s AND source IS NOT NULL', (last_id,))
+            sources.update([_[0] for _ in cur.fetchall()])
+            cur.execute('SELECT coalesce(max(id), %s) FROM log WHERE id > %s', (last_id, last_id))
+            last_id = cur.fetchone()[0]
+
+    cache.set('log_sources', (sources, last_id, created), _log_sources_ttl)
+
+    return sorted(sources)
+
+# Number of log messages per page
+_logs_page = 50
+
+def _log_key(message):
+    """Keyset pagination position of the log message"""
+    return '%s,%d' % (message.time.strftime('%Y-%m-%dT%H:%M:%S.%f'), message.id)
+
+def _parse_log_key(string):
+    """Position from _log_key(), or None if it is malformed"""
+    try:
+        time,id = string.split(',')
+        return datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f'), int(id)
+    except (ValueError, AttributeError):
+        return None
+
 def logs_list(request, source='all'):
+    logs = Log.objects.filter(time__isnull=False)
+
     if not source or source == 'all':
-        logs = Log.objects.order_by('-time')
         source = 'all'
     else:
-        logs = Log.objects.order_by('-time').filter(source=source)
+        logs = logs.filter(source=source)
+
+    # Filters, to be kept in pagination links
+    filters = {}
+    for name in ['q', 'type', 'time1', 'time2']:
+        if request.GET.get(name, '').strip():
+            filters[name] = request.GET.get(name).strip()
+
+    if 'type' in filters:
+        logs = logs.filter(type=filters['type'])
+    if 'time1' in filters and parse_date(filters['time1']):
+        logs = logs.filter(time__gte=parse_date(filters['time1']))
+    if 'time2' in filters and parse_date(filters['time2']):
+        logs = logs.filter(time__lte=parse_date(filters['time2']))
 
-    sources = [l['source'] for l in Log.objects.values('source').distinct()]
+    sources = log_sources()
     sources.append('all')
 
-    context = {'logs':logs, 'source':source, 'sources':sources}
+    context = {'source':source, 'sources':sources, 'filters':filters, 'query':urlencode(filters)}
+
+    if 'q' in filters:
+        # Full-text search over the GIN-indexed message_tsv column, best matching messages first
+        q = filters['q']
+        logs = logs.extra(select={'rank': "ts_rank(message_tsv, websearch_to_tsquery('english', %s))"}, select_params=[q],
+                          where=["message_tsv @@ websearch_to_tsquery('english', %s)"], params=[q])
+
+        try:
+            page = max(int(request.GET.get('page', 0)), 0)
+        except ValueError:
+            page = 0
+        logs = list(logs.order_by('-rank', '-time', '-id')[page*_logs_page:(page + 1)*_logs_page + 1])
+
+        context['logs'] = logs[:_logs_page]
+        context['prev_page'] = page - 1 if page > 0 else None
+        context['next_page'] = page + 1 if len(logs) > _logs_page else None
+
+        return TemplateResponse(request, 'logs.html', context=context)
+
+    # Keyset pagination - the page starts right before or after the (time, id) of given message,
+    # so that it is fetched by an index range scan with the same cost for any page
+    # Malformed positions lead to the latest page
+    after = _parse_log_key(request.GET.get('after'))
+    before = _parse_log_key(request.GET.get('before'))
+
+    if after:
+        logs = logs.extra(where=['(time, id) > (%s, %s)'], params=after)
+        logs = list(logs.order_by('time', 'id')[:_logs_page + 1])
+        newer = logs[_logs_page - 1] if len(logs) > _logs_page else None
+        logs = logs[:_logs_page][::-1]
+        older = logs[-1] if logs else None
+    else:
+        if before:
+            logs = logs.extra(where=['(time, id) < (%s, %s)'], params=before)
+        logs = list(logs.order_by('-time', '-id')[:_logs_page + 1])
+        older = logs[_logs_page - 1] if len(logs) > _logs_page else None
+        logs = logs[:_logs_page]
+        newer = logs[0] if logs and before else None
+
+    context['logs'] = logs
+    context['older'] = _log_key(older) if older else None
+    context['newer'] = _log_key(newer) if newer else None
 
     return TemplateResponse(request, 'logs.html', context=context)
+
+def _export(request, queryset, columns, name, time1):
+    """Streaming export of the queryset columns, in the format requested by format and gzip parameters"""
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in ['ndjson', 'csv']:
+        return HttpResponseBadRequest("Unsupported format %s, available ones are: ndjson, csv" % fmt)
+
+    compress = request.GET.get('gzip', '0').lower() not in ['', '0', 'false', 'no', 'off']
+
+    return streaming_export(atomic_iterator(queryset.values_list(*columns)), columns, fmt=fmt, compress=compress,
+                            filename='%s_%s' % (name, time1.strftime('%Y%m%d_%H%M%S')))
+
+def logs_export(request):
+    """Stream the log messages for the time range, optionally filtered by source and type, as NDJSON or CSV"""
+    time0,time1,time2,hours = status_time_range(request)
+
+    logs = Log.objects.filter(time__gt=time1, time__lte=time2)
+    if request.GET.get('source'):
+        logs = logs.filter(source=request.GET.get('source'))
+    if request.GET.get('type'):
+        logs = logs.filter(type=request.GET.get('type'))
+
+    return _export(request, logs.order_by('time', 'id'), ['time', 'source', 'type', 'message'], 'log', time1)
+
+def status_dump(request):
+    """Stream full status snapshots for the time range as NDJSON or CSV"""
+    time0,time1,time2,hours = status_time_range(request)
+
+    snapshots = MonitorStatus.objects.filter(time__gt=time1, time__lte=time2).order_by('time')
+
+    return _export(request, snapshots, ['time', 'status'], 'status', time1)
@@ -1,37 +1,40 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, JsonResponse, FileResponse
 from django.template.response import TemplateResponse
-
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-from matplotlib.dates import DateFormatter
-from matplotlib.patches import Ellipse
-from matplotlib.ticker import ScalarFormatter, LogLocator, LinearLocator, MaxNLocator, NullLocator
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.core.cache import cache
+from django.utils.cache import patch_cache_control
+from django.utils.http import urlencode
 
 import numpy as np
 
 try:
     from StringIO import StringIO ## for Python 2
-    from models import MonitorStatus
+    from models import MonitorStatus, MonitorValue, MonitorRollupMinute, MonitorRollupHour
+    from status_query import status_buckets
+    from resample import Expression, make_grid, resample, break_gaps
+    from render import render
+    from utils import parse_date, streaming_export
 except ImportError:
     from io import BytesIO
-    from . models import MonitorStatus
+    from . models import MonitorStatus, MonitorValue, MonitorRollupMinute, MonitorRollupHour
+    from . status_query import status_buckets
+    from . resample import Expression, make_grid, resample, break_gaps
+    from . render import render
+    from . utils import parse_date, streaming_export
 
-import datetime, re
+import datetime, re, functools, hashlib, tempfile
 
+from status_export import export_query, export_chunks, export_formats, write_export, cursor_chunks, extensions
 
 
 def parse_time(string):
-    # FIXME: parse more time formats!
+    time = parse_date(string)
 
-    for fmt in ["%Y.%m.%d %H:%M:%S", "%Y-%m-%d %H:%M:%S"]:
-        try:
-            time = datetime.datetime.strptime(string, fmt)
-            return time
-        except ValueError:
-            pass
+    if time is None:
+        print ("Can't parse time string:", string)
 
-    print ("Can't parse time string:", string)
-    return None
+    return time
 
 def status(request):
     context = {}
@@ -57,24 +60,195 @@ def status(request):
 
     return TemplateResponse(request, 'status.html', context=context)
 
-def is_number(s):
+def choose_rollup(time1, time2, width):
+    """Coarsest rollup model still giving at least one point per pixel, or None for raw values"""
+    if not getattr(settings, 'STATUS_ROLLUPS', False):
+        return None
+
+    step = (time2 - time1).total_seconds()/max(width, 1)
+
+    if step >= 3600:
+        return MonitorRollupHour
+    elif step >= 60:
+        return MonitorRollupMinute
+    else:
+        return None
+
+def status_time_range(request, hours=24.0):
+    """
+    Time range of the request, either from time1 to time2 (default to now), or given number of hours around time0,
+    or back from time2. Returns time0, time1, time2 and hours
+    """
     try:
-        float(s)
-        return True
+        hours = float(request.GET.get('hours', hours or 24.0))
     except ValueError:
-        return False
-
-def status_plot(request, params, width=1000.0, height=500.0, hours=24.0, title=None, xlabel="Time, UT", ylabel=None, ylog=False, grid=True):
-    hours = float(hours) if hours else 24.0
+        hours = hours or 24.0
 
     time0 = None # Mid-time for 'zooming' plot
 
-    time1,time2 = None,None
+    if 'time0' in request.GET.keys():
+        time0 = parse_time(request.GET.get('time0'))
+
+    if 'time1' in request.GET.keys() or 'time2' in request.GET.keys():
+        time2 = (parse_time(request.GET['time2']) if request.GET.get('time2') else None) or datetime.datetime.utcnow()
+        time1 = (parse_time(request.GET['time1']) if request.GET.get('time1') else None) or time2 - datetime.timedelta(hours=hours)
+        time0 = None
+        hours = (time2 - time1).total_seconds()/3600
+    elif time0 is not None:
+        time1 = time0 - datetime.timedelta(hours=hours/2)
+        time2 = time0 + datetime.timedelta(hours=hours/2)
+    else:
+        # Default time range is given number of hours back from now
+        time2 = datetime.datetime.utcnow()
+        time1 = time2 - datetime.timedelta(hours=hours)
+
+    return time0, time1, time2, hours
+
+def status_stamp(time1, time2):
+    """Number and the latest time of status snapshots within the time range, changing if any data are added there"""
+    with connections[router.db_for_read(MonitorStatus)].cursor() as cur:
+        cur.execute('SELECT count(*), max(time) FROM monitor_status WHERE time > %s AND time <= %s', (time1, time2))
+        return cur.fetchone()
+
+def cached_status(view):
+    """
+    Decorator caching the responses of status views, keyed by the request path and sorted parameters.
+    Time ranges ending before STATUS_CACHE_HORIZON are not expected to change, so they are cached for long
+    and marked so for the browser, with the ETag depending on the data. Others are cached until the next
+    status snapshot is stored by the monitor
+    """
+    @functools.wraps(view)
+    def wrapper(request, params, **kwargs):
+        time0,time1,time2,hours = status_time_range(request, kwargs.get('hours'))
+
+        now = datetime.datetime.utcnow()
+        interval = getattr(settings, 'STATUS_DB_INTERVAL', 60)
+
+        # Recent data may still be added by the monitor, rollup job, backfill or replication
+        past = time2 < now - datetime.timedelta(seconds=getattr(settings, 'STATUS_CACHE_HORIZON', 2*3600))
+
+        if past:
+            ttl = getattr(settings, 'STATUS_CACHE_TTL', 7*24*3600)
+        else:
+            ttl = interval - (now - datetime.datetime(1970, 1, 1)).total_seconds() % interval
+
+        key = request.path + '?' + urlencode(sorted(request.GET.items()))
+        if past:
+            # Late arriving snapshots change the key
+            key += '#%s,%s' % status_stamp(time1, time2)
+        key = 'status:' + hashlib.md5(key.encode('utf-8')).hexdigest()
+        etag = '"%s"' % key
+
+        if past and request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+
+        response = cache.get(key)
+
+        if response is None:
+            response = view(request, params, **kwargs)
+
+            if response.status_code == 200 and not response.streaming:
+                cache.set(key, response, ttl)
+
+        if past:
+            response['ETag'] = etag
+
+        patch_cache_control(response, max_age=int(ttl))
+
+        return response
+
+    return wrapper
+
+def status_series(labels, time1, time2, npoints=1000):
+    """
+    Time series of client.key variables for the time range, from the best available source, decimated to roughly
+    given number of points. Returns the lists of times, values, mins and maxs, the latter two being None if not available
+    """
+    rollup = choose_rollup(time1, time2, npoints)
+    mins,maxs = None,None
+
+    if rollup is not None:
+        # Pre-aggregated values, roughly one point per pixel regardless of the time range
+        times,values,mins,maxs = [],[],[],[]
+        for label in labels:
+            client,key = label.split('.', 1)
+            mr = rollup.objects.filter(client=client, key=key, time__gt=time1, time__lte=time2).order_by('time')
+            mr = list(mr.values_list('time', 'vmin', 'vmean', 'vmax'))
+            times.append([_[0] for _ in mr])
+            mins.append([_[1] for _ in mr])
+            values.append([_[2] for _ in mr])
+            maxs.append([_[3] for _ in mr])
+    elif getattr(settings, 'STATUS_VALUES', False):
+        # Numerical values from narrow monitor_values table, one index range scan per variable
+        times,values = [],[]
+        for label in labels:
+            client,key = label.split('.', 1)
+            mv = MonitorValue.objects.filter(client=client, key=key, time__gt=time1, time__lte=time2).order_by('time')
+            mv = list(mv.values_list('time', 'value'))
+            times.append([_[0] for _ in mv])
+            values.append([_[1] for _ in mv])
+    else:
+        # Values from JSONB snapshots, aggregated by the database into given number of time buckets.
+        # Snapshots are selected by the same conditions as partial indexes created by `db_admin.py indexes`
+        time,mins,values,maxs = status_buckets(labels, time1, time2, nbuckets=npoints)
+        times = [time for _ in labels]
+
+    # The snapshots with no values, e.g. when the client was disconnected, are not selected,
+    # so the gaps longer than expected spacing of points are marked explicitly
+    max_gap = 2.5*max((time2 - time1).total_seconds()/max(npoints, 1), getattr(settings, 'STATUS_DB_INTERVAL', 60),
+                      3600 if rollup is MonitorRollupHour else 60 if rollup is MonitorRollupMinute else 0)
+
+    values = list(values)
+    if mins is not None:
+        mins,maxs = list(mins),list(maxs)
+
+    for i in range(len(labels)):
+        times[i],series = break_gaps(times[i], [values[i]] + ([mins[i], maxs[i]] if mins is not None else []), max_gap)
+        values[i] = series[0]
+        if mins is not None:
+            mins[i],maxs[i] = series[1:]
+
+    return times, values, mins, maxs
+
+def status_aligned(expressions, time1, time2, npoints=1000, method='linear'):
+    """
+    Values of the expressions over client.key variables, with all variables resampled onto a common time grid
+    of given number of points using given method. Returns the grid times and the list of value arrays
+    """
+    variables = []
+    for expr in expressions:
+        variables += [_ for _ in expr.variables if _ not in variables]
+
+    times,values,mins,maxs = status_series(variables, time1, time2, npoints=npoints)
+
+    grid = make_grid(time1, time2, npoints)
+    data = {var: resample(times[i], values[i], grid, method=method) for i,var in enumerate(variables)}
+
+    return grid, [_.evaluate(data, size=len(grid)) for _ in expressions]
+
+def parse_expressions(request, params):
+    """
+    Parse comma-separated list of client.key variables or expressions over them, and decide whether they need resampling.
+    Raises ValueError for invalid expressions
+    """
+    expressions = [Expression(_) for _ in params.rstrip('/').split(',')]
+    method = request.GET.get('resample')
+
+    if method is None and not all([_.is_variable() for _ in expressions]):
+        method = 'linear'
+
+    if method not in [None, 'nearest', 'linear', 'mean']:
+        raise ValueError("Unknown resampling method: %s" % method)
+
+    return expressions, method
+
+@cached_status
+def status_plot(request, params, width=1000.0, height=500.0, hours=24.0, title=None, xlabel="Time, UT", ylabel=None, ylog=False, grid=True):
+    time0,time1,time2,hours = status_time_range(request, hours)
 
     if request.GET:
         width = float(request.GET.get('width', width))
         height = float(request.GET.get('height', height))
-        hours = float(request.GET.get('hours', hours))
         if 'ylog' in request.GET.keys():
             # FIXME: make it possible to pass False somehow
             ylog = True
@@ -83,18 +257,6 @@ def status_plot(request, params, width=1000.0, height=500.0, hours=24.0, title=N
         xlabel = request.GET.get('xlabel', xlabel)
         ylabel = request.GET.get('ylabel', ylabel)
 
-        # Time range
-        if 'time0' in request.GET.keys():
-            time0 = parse_time(request.GET.get('time0'))
-
-            time1 = time0 - datetime.timedelta(hours=hours/2)
-            time2 = time0 + datetime.timedelta(hours=hours/2)
-
-    if time1 is None or time2 is None:
-        # Default time range is given number of hours back from now
-        time1 = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
-        time2 = datetime.datetime.utcnow()
-
     if not title:
         title = params
 
@@ -103,92 +265,161 @@ def status_plot(request, params, width=1000.0, height=500.0, hours=24.0, title=N
         else:
             title += ' : ' + time1.strftime('%Y.%m.%d %H:%M:%S') + ' UT - ' + time2.strftime('%Y.%m.%d %H:%M:%S') + ' UT'
 
-    # Parse comma-separated list of client.param strings
+    # Parse comma-separated list of client.param strings or expressions over them
     # TODO: add support for root level parameters, with no dots
-    params = params.split(',')
-    select = {}
-    where = []
+    try:
+        expressions,method = parse_expressions(request, params)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
 
-    if not ylabel and len(params) == 1:
-        ylabel = params[0]
+    labels = [_.label for _ in expressions]
 
-    labels = []
-    for param in params:
-        s = param.split('.') # Split
-        # select[s[0]+'.'+s[1]] = "(status #> '{%s}' #>> '{%s}')::float" % (s[0], s[1])
-        # where.append("(status #> '{%s}' #>> '{%s}' != 'None')" % (s[0], s[1]))
-        select[s[0]+'.'+s[1]] = "(status #> '{%s}' #>> '{%s}')" % (s[0], s[1])
-        labels.append(s[0]+'.'+s[1])
+    if not ylabel and len(labels) == 1:
+        ylabel = labels[0]
 
-    ms = MonitorStatus.objects.extra(select=select, where=where).defer('status').order_by('time')
-    ms = ms.filter(time__gt = time1)
-    ms = ms.filter(time__lte = time2)
+    if method is None:
+        times,values,mins,maxs = status_series(labels, time1, time2, npoints=int(width))
+    else:
+        # Variables aligned onto common time grid, and derived quantities computed over them
+        time,values = status_aligned(expressions, time1, time2, npoints=int(width), method=method)
+        times,mins,maxs = [time for _ in labels],None,None
 
-    values = [[getattr(_,__) for _ in ms] for __ in labels]
-    time = [_.time for _ in ms]
+    labels = [label.split('.')[-1] if expressions[_].is_variable() else label for _,label in enumerate(labels)]
 
-    fig = Figure(facecolor='white', dpi=72, figsize=(width*1.0/72, height*1.0/72), tight_layout=True)
-    ax = fig.add_subplot(111)
-    ax.autoscale()
-    # ax.plot()
+    mark = None
+    if request.GET and 'mark' in request.GET.keys():
+        mark = parse_time(request.GET.get('mark'))
 
-    has_data = False
+    png = render(times, values, mins, maxs, labels, time1, time2, width=width, height=height, title=title,
+                 xlabel=xlabel, ylabel=ylabel, ylog=ylog, grid=grid, mark=mark)
 
-    for _,value in enumerate(values):
-        if np.any(np.array(value) != None):
-            has_data = True
+    response = HttpResponse(png, content_type='image/png')
 
-            if len(value) and is_number(value[0]):
-                value = np.double(['nan' if _ == 'None' else _ for _ in value])
+    return response
 
-            ax.plot(time, value, '-', label=labels[_].split('.')[-1])
+def status_export(request, params, hours=24.0):
+    """Export client.key variables for the time range to columnar file - npz, or parquet and hdf5 if supported"""
+    try:
+        expressions = [Expression(_) for _ in params.rstrip('/').split(',')]
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
 
-    # if time and has_data: # It is failing if no data are plotted
-    if (time2 - time1).total_seconds() < 2*24*3600:
-        ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
-    elif (time2 - time1).total_seconds() > 3*24*3600:
-        ax.xaxis.set_major_formatter(DateFormatter('%Y.%m.%d'))
-    else:
-        ax.xaxis.set_major_formatter(DateFormatter('%Y.%m.%d %H:%M:%S'))
+    if not all([_.is_variable() for _ in expressions]):
+        return HttpResponseBadRequest("Only client.key variables may be exported")
 
-    fig.autofmt_xdate()
+    variables = [_.variables[0] for _ in expressions]
 
-    if request.GET and 'mark' in request.GET.keys():
-        time_mark = parse_time(request.GET.get('mark'))
-        ax.axvline(time_mark, color='red', ls='--', alpha=1.0)
+    fmt = request.GET.get('format', 'npz')
+    if fmt not in export_formats():
+        return HttpResponseBadRequest("Unsupported format %s, available ones are: %s" % (fmt, ", ".join(export_formats())))
+
+    time0,time1,time2,hours = status_time_range(request, hours)
 
-    ax.set_xlim(time1, time2)
+    # The formats need seekable file to be written, so it is spooled to disk and then streamed from there
+    s = tempfile.TemporaryFile()
 
-    ax.set_xlabel(xlabel)
-    ax.set_ylabel(ylabel)
-    ax.set_title(title)
-    ax.grid(grid)
+    # Server-side cursor so that the rows are read in chunks, it needs the transaction
+    using = router.db_for_read(MonitorStatus)
+    with transaction.atomic(using=using):
+        with connections[using].chunked_cursor() as cur:
+            cur.execute(export_query(variables), (time1, time2))
+            write_export(s, cursor_chunks(cur), variables, format=fmt)
 
-    if len(labels) > 1:
-        ax.legend(frameon=True, loc=2, framealpha=0.99)
+    s.seek(0)
 
-    if ylog:
-        ax.set_yscale('log', nonpositive='clip')
+    # Closes the file, thus deleting it, when sent
+    response = FileResponse(s, content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="status_%s%s"' % (time1.strftime('%Y%m%d_%H%M%S'), extensions[fmt])
 
-        # Try to fix the ticks if the data span is too small
-        axis = ax.get_yaxis()
-        print (np.ptp(np.log10(axis.get_data_interval())))
-        if np.ptp(np.log10(axis.get_data_interval())) < 1:
-            axis.set_major_locator(MaxNLocator())
-            axis.set_minor_locator(NullLocator())
+    return response
 
-    # 10% margins on both axes
-    ax.margins(0.03, 0.03)
+def _unix(times):
+    """Unix timestamps, in seconds, for the list or array of times"""
+    return np.array(times, dtype='datetime64[us]').astype('i8')/1e6
+
+def _json_list(values):
+    """List of floats with NaNs, infinities and Nones replaced by nulls, as JSON does not support them"""
+    values = np.array(values, dtype=float)
+
+    return [float(_) if np.isfinite(_) else None for _ in values]
+
+@cached_status
+def status_data(request, params, hours=24.0):
+    """
+    Values of client.key variables for the time range as JSON columns or CSV, for client-side plotting.
+    With points=N the values are decimated on the server to roughly N points, as for the plots, with min/max ranges.
+    Otherwise, all values from status snapshots on a common time axis are returned, CSV ones being streamed
+    """
+    time0,time1,time2,hours = status_time_range(request, hours)
+    fmt = request.GET.get('format', 'json')
+    try:
+        points = int(request.GET.get('points', 0))
+    except ValueError:
+        return HttpResponseBadRequest("Number of points should be integer")
 
-    # handles, labels = ax.get_legend_handles_labels()
-    # ax.legend(handles, labels, loc=2)
+    if fmt not in ['json', 'csv']:
+        return HttpResponseBadRequest("Unsupported format %s, available ones are: json, csv" % fmt)
 
-    canvas = FigureCanvas(fig)
     try:
-        s = StringIO() # Python2
-    except:
-        s = BytesIO()
-    canvas.print_png(s)
-    response = HttpResponse(s.getvalue(), content_type='image/png')
+        expressions,method = parse_expressions(request, params)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
 
-    return response
+    labels = [_.label for _ in expressions]
+
+    if method is not None:
+        # Common time grid for all variables and expressions
+        time,values = status_aligned(expressions, time1, time2, npoints=points or 1000, method=method)
+        time = _unix(time)
+
+        if fmt == 'json':
+            return JsonResponse({'time1': _unix([time1])[0], 'time2': _unix([time2])[0], 'time': time.tolist(),
+                                 'variables': {label: _json_list(values[i]) for i,label in enumerate(labels)}})
+        else:
+            columns = ['time'] + labels
+            def rows():
+                for j,t in enumerate(time):
+                    yield [t] + [_[j] for _ in values]
+    elif points > 0:
+        times,values,mins,maxs = status_series(labels, time1, time2, npoints=points)
+
+        if fmt == 'json':
+            data = {'time1': _unix([time1])[0], 'time2': _unix([time2])[0], 'variables': {}}
+            for i,label in enumerate(labels):
+                data['variables'][label] = {'time': _unix(times[i]).tolist(), 'value': _json_list(values[i])}
+                if mins is not None:
+                    data['variables'][label]['min'] = _json_list(mins[i])
+                    data['variables'][label]['max'] = _json_list(maxs[i])
+
+            return JsonResponse(data)
+        else:
+            columns = ['variable', 'time', 'value', 'min', 'max']
+            def rows():
+                for i,label in enumerate(labels):
+                    for j,t in enumerate(_unix(times[i])):
+                        yield [label, t, values[i][j], mins[i][j] if mins is not None else '', maxs[i][j] if maxs is not None else '']
+    else:
+        if fmt == 'json':
+            time,values = [],[[] for _ in labels]
+            with connections[router.db_for_read(MonitorStatus)].cursor() as cur:
+                cur.execute(export_query(labels), (time1, time2))
+                for chunk in export_chunks(cursor_chunks(cur), labels):
+                    time += _unix(chunk['time']).tolist()
+                    for i,label in enumerate(labels):
+                        values[i] += _json_list(chunk[label])
+
+            return JsonResponse({'time1': _unix([time1])[0], 'time2': _unix([time2])[0], 'time': time,
+                                 'variables': {label: values[i] for i,label in enumerate(labels)}})
+        else:
+            columns = ['time'] + labels
+            def rows():
+                # Server-side cursor, so that the rows are read in chunks while being streamed
+                using = router.db_for_read(MonitorStatus)
+                with transaction.atomic(using=using):
+                    with connections[using].chunked_cursor() as cur:
+                        cur.execute(export_query(labels), (time1, time2))
+                        for chunk in export_chunks(cursor_chunks(cur), labels):
+                            for j,t in enumerate(_unix(chunk['time'])):
+                                yield [t] + [chunk[label][j] for label in labels]
+
+    return streaming_export(rows(), columns, fmt='csv', filename='status_%s' % time1.strftime('%Y%m%d_%H%M%S'))
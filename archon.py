@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import startup_profile
+
 import os, sys
 
 from daemon import SimpleFactory, SimpleProtocol
@@ -58,7 +60,7 @@ class DaemonProtocol(SimpleProtocol):
 
     @catch
     def update(self):
-        self.factory.messageAll('get_status', name='monitor')
+        self.factory.messageAll('get_status', type='monitor')
 
 class ArchonProtocol(SimpleProtocol):
     _debug = False # Display all traffic for debug purposes
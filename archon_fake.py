@@ -8,6 +8,8 @@
 
 # from os import linesep
 
+import startup_profile
+
 import os, sys
 
 from daemon import SimpleFactory, SimpleProtocol
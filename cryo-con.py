@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
+import startup_profile
+
 import os
 import sys
 import re
-import numpy as np
+from math import nan
 
 from daemon import SimpleFactory, SimpleProtocol
 from command import Command
@@ -273,7 +275,7 @@ class CryoConProtocol(SimpleProtocol):
                                 self.object[channel[s]] = sstring[s]
                             except ValueError:
                                 status = status + '0'
-                                self.object[channel[s]] = np.nan
+                                self.object[channel[s]] = nan
                         self.object['control'] = sstring[4]
                         self.object['status'] = status
                     else:
@@ -348,10 +350,10 @@ if __name__ == '__main__':
     # May be anything that will be passed by reference - list, dict, object etc
     obj = {'hw_connected': 0,
            'status': '----', 'temperatureA': 0, 'temperatureB': 0, 'temperatureC': 0, 'temperatureD': 0, 'control':'-',
-           'htr_status1': '-', 'range1': '-', 'ctrl_type1': '-', 'pwr_set1': 0, 'pwr_actual1': 0, 'load1': 0, 'source1': '-', 'set_point1': np.nan, 'ramp1': '-', 'rate1': np.nan, 'pwr_man1': np.nan,
-           'htr_status2': '-', 'range2': '-', 'ctrl_type2': '-', 'pwr_set2': 0, 'pwr_actual2': 0, 'load2': 0, 'source2': '-', 'set_point2': np.nan, 'ramp2': '-', 'rate2': np.nan,'pwr_man2': np.nan,
-           'htr_status3': '-', 'range3': '-', 'ctrl_type3': '-', 'pwr_set3': 0, 'pwr_actual3': 0, 'load3': 0, 'source3': '-', 'set_point3': np.nan, 'ramp3': '-', 'rate3': np.nan,'pwr_man3': np.nan,
-           'htr_status4': '-', 'range4': '-', 'ctrl_type4': '-', 'pwr_set4': 0, 'pwr_actual4': 0, 'load4': 0, 'source4': '-', 'set_point4': np.nan, 'ramp4': '-', 'rate4': np.nan,'pwr_man4': np.nan}
+           'htr_status1': '-', 'range1': '-', 'ctrl_type1': '-', 'pwr_set1': 0, 'pwr_actual1': 0, 'load1': 0, 'source1': '-', 'set_point1': nan, 'ramp1': '-', 'rate1': nan, 'pwr_man1': nan,
+           'htr_status2': '-', 'range2': '-', 'ctrl_type2': '-', 'pwr_set2': 0, 'pwr_actual2': 0, 'load2': 0, 'source2': '-', 'set_point2': nan, 'ramp2': '-', 'rate2': nan,'pwr_man2': nan,
+           'htr_status3': '-', 'range3': '-', 'ctrl_type3': '-', 'pwr_set3': 0, 'pwr_actual3': 0, 'load3': 0, 'source3': '-', 'set_point3': nan, 'ramp3': '-', 'rate3': nan,'pwr_man3': nan,
+           'htr_status4': '-', 'range4': '-', 'ctrl_type4': '-', 'pwr_set4': 0, 'pwr_actual4': 0, 'load4': 0, 'source4': '-', 'set_point4': nan, 'ramp4': '-', 'rate4': nan,'pwr_man4': nan}
 
     # Factories for daemon and hardware connections
     # We need two different factories as the protocols are different
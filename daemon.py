@@ -6,10 +6,8 @@ from twisted.application.service import Service
 from twisted.internet.endpoints import TCP4ServerEndpoint, TCP4ClientEndpoint, connectProtocol
 from twisted.protocols.basic import LineReceiver
 from twisted.internet.task import LoopingCall
-from twisted.internet.serialport import SerialPort
 
-import pylibftdi
-from pyudev import Context, Monitor, MonitorObserver
+# Hardware backends (pylibftdi, pyudev, serial ports) are imported only by the protocols using them
 
 import os
 import sys
@@ -20,6 +18,7 @@ import logging
 logging.basicConfig(level=logging.ERROR)
 
 from command import Command
+import startup_profile
 
 
 def catch(func):
@@ -39,9 +38,14 @@ class FTDIProtocol(Protocol):
     """ Class for outgoing connection to a FTDI device """
     _debug = False
     _refresh = 1.0
-    pylibftdi.USB_PID_LIST.append(0xFAF0)
 
     def __init__(self, serial_num, obj, refresh=0, baudrate=115200):
+        import pylibftdi
+        from pyudev import Context, Monitor, MonitorObserver
+
+        if 0xFAF0 not in pylibftdi.USB_PID_LIST:
+            pylibftdi.USB_PID_LIST.append(0xFAF0)
+
         # Name and type of the connection peer
         self.name = ''
         self.type = ''
@@ -93,6 +97,8 @@ class FTDIProtocol(Protocol):
                 self.ConnectionMade()
 
     def ConnectionMade(self):
+        import pylibftdi
+
         self.device.open()
         self.device.baudrate = self.baudrate
         self.device.ftdi_fn.ftdi_set_line_property(8, 1, 0)  # number of bits, number of stop bits, no parity
@@ -157,6 +163,8 @@ class SerialUSBProtocol(Protocol):
 
         self._updateTimer = LoopingCall(self.update)
 
+        from pyudev import Context, Monitor, MonitorObserver
+
         context = Context()
         for device in context.list_devices(subsystem='tty'):
             if device.get('ID_SERIAL_SHORT') == self.serial_num:
@@ -169,6 +177,8 @@ class SerialUSBProtocol(Protocol):
         observer.start()
 
     def Connect(self):
+        from twisted.internet.serialport import SerialPort
+
         self.object['hw'] = SerialPort(self, self._devname, self.object['daemon']._reactor,
                                        baudrate=self.baudrate, bytesize=self.bytesize, parity=self.parity, stopbits=self.stopbits, timeout=self.timeout)
 
@@ -385,6 +395,9 @@ class SimpleFactory(Factory):
             from twisted.internet import reactor
             self._reactor = reactor
 
+        # Startup time breakdown, if requested with --profile-startup
+        startup_profile.schedule(self._reactor)
+
     def buildProtocol(self, addr):
         p = self._protocol()
 
@@ -435,10 +448,11 @@ class SimpleFactory(Factory):
         if reconnect:
             service = ClientService(ep, self, retryPolicy=lambda x: 1)
             service.startService()
+            return service
         else:
             ep.connect(self)
 
     def log(self, message, type='info'):
         """Generic interface for sending system-level log messages, to be stored to DB and shown in GUI"""
         # TODO: should we send it to specific names/types only?
-        self.messageAll(type + ' ' + message, name='monitor')
+        self.messageAll(type + ' ' + message, type='monitor')
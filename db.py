@@ -1,13 +1,126 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import psycopg2, psycopg2.extras
 import datetime
+import time
+import json
+import threading
+import abc
+from contextlib import contextmanager
 
 import numpy as np
 
-class DB:
-    """Class encapsulating the connection to PostgreSQL database"""
-    def __init__(self, dbname='ccdlab', dbhost='', dbport=0, dbuser='', dbpassword='', readonly=False):
+try:
+    import psycopg2, psycopg2.extras, psycopg2.pool, psycopg2.errors
+
+    # FIXME: the following adapter is registered globally!
+    psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
+
+    _BaseConnection = psycopg2.extensions.connection
+except ImportError:
+    # Only the local storage from db_local is available then
+    psycopg2 = None
+    _BaseConnection = object
+
+def status_values(status):
+    """Numerical values from the monitor status dictionary, as a list of (client, key, value) tuples"""
+    values = []
+
+    for client, cstatus in status.items():
+        if not isinstance(cstatus, dict):
+            continue
+
+        for key, value in cstatus.items():
+            try:
+                values.append((client, key, float(value)))
+            except (ValueError, TypeError):
+                pass
+
+    return values
+
+class _Connection(_BaseConnection):
+    """Pooled connection keeping track of its session setup and prepared statements"""
+    def __init__(self, *args, **kwargs):
+        _BaseConnection.__init__(self, *args, **kwargs)
+        self.configured = False
+        self.prepared = set()
+        self.last_used = time.time()
+
+class BaseDB(abc.ABC):
+    """Storage backend interface used by MONITOR and scripts"""
+    def __init__(self):
+        # Deferred writes still running in the thread pool
+        self._deferred = set()
+
+    @abc.abstractmethod
+    def query(self, string="", data=(), simplify=True, debug=False, array=False):
+        pass
+
+    @abc.abstractmethod
+    def log(self, message, time=None, source=None, type='info'):
+        pass
+
+    @abc.abstractmethod
+    def store_status(self, status, time=None):
+        pass
+
+    def flush(self):
+        """Commit the writes buffered in memory, if any"""
+        pass
+
+    def close(self):
+        pass
+
+    # Twisted-friendly wrappers running the queries in a thread pool and returning Deferreds
+    def _defer(self, func, *args, **kwargs):
+        from twisted.internet.threads import deferToThread
+
+        d = deferToThread(func, *args, **kwargs)
+        self._deferred.add(d)
+
+        def done(result):
+            self._deferred.discard(d)
+            return result
+
+        return d.addBoth(done)
+
+    def deferFlush(self):
+        return self._defer(self.flush)
+
+    def deferClose(self):
+        """Close the database once all deferred writes are finished, e.g. from 'before' shutdown trigger"""
+        from twisted.internet.defer import DeferredList
+
+        d = DeferredList(list(self._deferred), consumeErrors=True)
+        d.addBoth(lambda _: self.close())
+
+        return d
+
+    def deferQuery(self, *args, **kwargs):
+        return self._defer(self.query, *args, **kwargs)
+
+    def deferLog(self, *args, **kwargs):
+        return self._defer(self.log, *args, **kwargs)
+
+    def deferStoreStatus(self, status, time=None):
+        # Serialize the status right away, as the caller may modify it while the query is waiting in the thread pool
+        return self._defer(self.store_status, json.dumps(status), time=time)
+
+class DB(BaseDB):
+    """Class encapsulating the pool of connections to PostgreSQL database"""
+    # Statements prepared on every connection on first use, name: (argument types, statement)
+    _prepared = {
+        'log_insert': ('(timestamp, text, text, text)', 'INSERT INTO log (time, source, type, message) VALUES ($1, $2, $3, $4)'),
+        'status_insert': ('(timestamp, jsonb)', 'INSERT INTO monitor_status (time, status) VALUES ($1, $2)'),
+    }
+
+    # Connections idle for longer than this number of seconds are checked before use
+    _health_interval = 60
+
+    # Whether to store numerical status values to monitor_values table alongside the JSONB snapshots.
+    # Will be switched off automatically if the table does not exist
+    store_values = True
+
+    def __init__(self, dbname='ccdlab', dbhost='', dbport=0, dbuser='', dbpassword='', readonly=False, minconn=1, maxconn=4):
         connstring = "dbname=" + dbname
         if dbhost:
             connstring += " host="+dbhost
@@ -18,67 +131,248 @@ class DB:
         if dbpassword:
             connstring += " password='%s'" % dbpassword
 
+        BaseDB.__init__(self)
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+
         self.connect(connstring, readonly)
 
     def connect(self, connstring, readonly=False):
-        self.conn = psycopg2.connect(connstring)
-        self.conn.autocommit = True
-        self.conn.set_session(readonly=readonly)
-        psycopg2.extras.register_default_jsonb(self.conn)
-        # FIXME: the following adapter is registered globally!
-        psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is not installed")
+
+        self.pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, connstring, connection_factory=_Connection)
+        # ThreadedConnectionPool raises an error when exhausted, so we make the callers wait instead
+        self._semaphore = threading.BoundedSemaphore(self.maxconn)
 
         self.connstring = connstring
         self.readonly = readonly
 
-    def query(self, string="", data=(), simplify=True, debug=False, array=False):
-        if self.conn.closed:
-            print("Re-connecting to DB")
-            self.connect(self.connstring, self.readonly)
+    def close(self):
+        self.pool.closeall()
+
+    def getconn(self):
+        """Get the healthy connection from the pool, waiting for it if all are in use"""
+        self._semaphore.acquire()
+
+        try:
+            while True:
+                conn = self.pool.getconn()
+
+                if not conn.closed and time.time() - conn.last_used > self._health_interval:
+                    # Connection was idle for a while, check it is still alive
+                    try:
+                        with conn.cursor() as cur:
+                            cur.execute('SELECT 1')
+                    except psycopg2.Error:
+                        pass
 
-        cur = self.conn.cursor(cursor_factory = psycopg2.extras.DictCursor)
+                if conn.closed:
+                    print("Re-connecting to DB")
+                    self.pool.putconn(conn, close=True)
+                    continue
 
-        if debug:
-            print(cur.mogrify(string, data))
+                if not conn.configured:
+                    conn.autocommit = True
+                    conn.set_session(readonly=self.readonly)
+                    psycopg2.extras.register_default_jsonb(conn)
+                    conn.configured = True
 
-        if data:
-            cur.execute(string, data)
-        else:
-            cur.execute(string)
+                return conn
+        except:
+            self._semaphore.release()
+            raise
 
+    def putconn(self, conn, close=False):
+        """Return the connection to the pool, closing it if it is broken"""
+        conn.last_used = time.time()
         try:
+            self.pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self._semaphore.release()
+
+    @contextmanager
+    def cursor(self, cursor_factory=None):
+        """Context manager providing the cursor on pooled connection, e.g.
+        with db.cursor() as cur:
+            cur.execute(...)
+        """
+        conn = self.getconn()
+        broken = False
+
+        try:
+            with conn.cursor(cursor_factory=cursor_factory) as cur:
+                yield cur
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def query(self, string="", data=(), simplify=True, debug=False, array=False):
+        # Only the queries not modifying anything may be safely repeated, as the connection may be lost
+        # after the server has already committed the statement
+        retry = self.readonly or self._is_read_only(string)
+
+        for attempt in [0, 1]:
+            try:
+                return self._query(string, data, simplify=simplify, debug=debug, array=array)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Connection was lost, retry once on another one
+                if attempt or not retry:
+                    raise
+                print("Re-connecting to DB")
+
+    def _is_read_only(self, string):
+        words = string.split(None, 1)
+        return bool(words) and words[0].upper() in ['SELECT', 'SHOW', 'VALUES', 'TABLE']
+
+    def _query(self, string="", data=(), simplify=True, debug=False, array=False):
+        # Plain tuple cursor is much faster for array results
+        with self.cursor(cursor_factory = None if array else psycopg2.extras.DictCursor) as cur:
+            if debug:
+                print(cur.mogrify(string, data))
+
+            if data:
+                cur.execute(string, data)
+            else:
+                cur.execute(string)
+
+            if cur.description is None:
+                # Nothing returned from the query
+                return None
+
+            if array:
+                return self.fetch_array(cur)
+
             result = cur.fetchall()
             # Simplify the result if it is simple
-            if array:
-                # Code from astrolibpy, https://code.google.com/p/astrolibpy
-                strLength = 10
-                __pgTypeHash = {
-                    16:bool,18:str,20:'i8',21:'i2',23:'i4',25:'|S%d'%strLength,700:'f4',701:'f8',
-                    1042:'|S%d'%strLength,#character()
-                    1043:'|S%d'%strLength,#varchar
-                    1700:'f8' #numeric
-                }
-
-                desc = cur.description
-                names = [d.name for d in desc]
-                formats = [__pgTypeHash.get(d.type_code, '|O') for d in desc]
-
-                table = np.recarray(shape=(cur.rowcount,), formats=formats, names=names)
-
-                for i,v in enumerate(result):
-                    table[i] = tuple(v)
-
-                return table
-            elif simplify and len(result) == 1:
+            if simplify and len(result) == 1:
                 if len(result[0]) == 1:
                     return result[0][0]
                 else:
                     return result[0]
             else:
                 return result
-        except:
-            # Nothing returned from the query
-            return None
+
+    def iter_query(self, string="", data=(), chunk=10000, array=False):
+        """Generator running the query on server-side cursor and yielding the results in chunks of given number of rows,
+        either as lists of tuples or, with array=True, as numpy record arrays. Memory usage does not depend on the result size, e.g.
+        for rows in db.iter_query('SELECT * FROM monitor_status WHERE time > %s', (time,)):
+            ...
+        """
+        conn = self.getconn()
+        broken = False
+
+        self._cursor_id = getattr(self, '_cursor_id', 0) + 1
+        name = 'iter_query_%d_%d' % (id(self), self._cursor_id)
+
+        try:
+            # Named cursors work only inside transactions
+            conn.autocommit = False
+
+            with conn.cursor(name) as cur:
+                cur.itersize = chunk
+                cur.execute(string, data or None)
+
+                while True:
+                    rows = cur.fetchmany(chunk)
+                    if not rows:
+                        break
+
+                    if array:
+                        names = [d.name for d in cur.description]
+                        columns = [self._column(values, d.type_code) for values,d in zip(zip(*rows), cur.description)]
+                        yield np.rec.fromarrays(columns, names=names)
+                    else:
+                        yield rows
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not broken and not conn.closed:
+                try:
+                    # Also closes the transaction if the generator was not exhausted
+                    conn.rollback()
+                    conn.autocommit = True
+                except psycopg2.Error:
+                    broken = True
+            self.putconn(conn, close=broken)
+
+    # Numpy types for PostgreSQL type OIDs
+    _pg_types = {16:bool, 20:'i8', 21:'i2', 23:'i4', 700:'f4', 701:'f8',
+                 1700:'f8', # numeric
+                 1114:'datetime64[us]', # timestamp
+    }
+    # String types - text, char, character(), varchar
+    _pg_strings = [18, 25, 1042, 1043]
+
+    def fetch_columns(self, cur, chunk=100000):
+        """Read the rows from the cursor in chunks and convert them to the list of typed numpy columns"""
+        desc = cur.description
+        chunks = [[] for _ in desc]
+
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+
+            for i,values in enumerate(zip(*rows)):
+                chunks[i].append(self._column(values, desc[i].type_code))
+
+        columns = []
+        for i,d in enumerate(desc):
+            if chunks[i]:
+                columns.append(np.concatenate(chunks[i]))
+            else:
+                columns.append(self._column((), d.type_code))
+
+        return columns
+
+    def fetch_array(self, cur, chunk=100000):
+        """Read all rows from the cursor into numpy record array"""
+        names = [d.name for d in cur.description]
+        columns = self.fetch_columns(cur, chunk=chunk)
+
+        return np.rec.fromarrays(columns, names=names)
+
+    def _column(self, values, type_code):
+        """Convert the tuple of column values to numpy array of appropriate type"""
+        if type_code in self._pg_strings:
+            return np.array(['' if _ is None else _ for _ in values], dtype=np.str_)
+
+        dtype = self._pg_types.get(type_code)
+        if dtype is bool and None in values:
+            # Boolean column with NULLs, which numpy would silently turn to False
+            return np.array([np.nan if _ is None else float(_) for _ in values], dtype='f8')
+
+        if dtype is not None:
+            try:
+                # NULLs become NaNs for floats and NaTs for timestamps
+                return np.array(values, dtype=dtype)
+            except (TypeError, ValueError):
+                if dtype in ['i2', 'i4', 'i8']:
+                    # Integer column with NULLs
+                    return np.array([np.nan if _ is None else _ for _ in values], dtype='f8')
+
+        # Everything else is kept as Python objects
+        column = np.empty(len(values), dtype=object)
+        for i,v in enumerate(values):
+            column[i] = v
+
+        return column
+
+    def execute_prepared(self, name, data):
+        """Execute the statement from _prepared list, preparing it on the connection if necessary"""
+        with self.cursor() as cur:
+            conn = cur.connection
+            if name not in conn.prepared:
+                types, statement = self._prepared[name]
+                cur.execute('PREPARE %s %s AS %s' % (name, types, statement))
+                conn.prepared.add(name)
+
+            cur.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s']*len(data))), data)
 
     def log(self, message, time=None, source=None, type='info'):
         """Store message to log table. Time is assumed to be in UTC scale, default to present moment."""
@@ -88,4 +382,24 @@ class DB:
         if not source:
             source = ''
 
-        self.query('INSERT INTO log (time, source, type, message) VALUES (%s, %s, %s, %s);', (time, source, type, message))
+        self.execute_prepared('log_insert', (time, source, type, message))
+
+    def store_status(self, status, time=None):
+        """Store monitor status dictionary, or its JSON string, to monitor_status and monitor_values tables"""
+        if time is None:
+            time = datetime.datetime.utcnow()
+
+        self.execute_prepared('status_insert', (time, status))
+
+        if self.store_values:
+            if not isinstance(status, dict):
+                status = json.loads(status)
+
+            rows = [(time,) + _ for _ in status_values(status)]
+
+            try:
+                with self.cursor() as cur:
+                    psycopg2.extras.execute_values(cur, 'INSERT INTO monitor_values (time, client, key, value) VALUES %s', rows)
+            except psycopg2.errors.UndefinedTable:
+                print("No monitor_values table, numerical values will not be stored separately")
+                self.store_values = False
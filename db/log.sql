@@ -5,6 +5,11 @@ CREATE TABLE log (
        time TIMESTAMP,
        source TEXT,
        type TEXT DEFAULT 'info',
-       message TEXT
+       message TEXT,
+       -- Full-text search vector, maintained by the database
+       message_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', coalesce(message, ''))) STORED
 );
-CREATE INDEX ON log (time);
+-- Indexes matching (time, id) ordering of the log viewer pages
+CREATE INDEX ON log (time, id);
+CREATE INDEX ON log (source, time, id);
+CREATE INDEX ON log USING gin (message_tsv);
@@ -0,0 +1,4 @@
+--- Full-text search over the log messages, for the databases created before it was added to log.sql
+--- Requires PostgreSQL 12 or newer
+ALTER TABLE log ADD COLUMN IF NOT EXISTS message_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', coalesce(message, ''))) STORED;
+CREATE INDEX IF NOT EXISTS log_message_tsv_idx ON log USING gin (message_tsv);
@@ -0,0 +1,24 @@
+--- Per-minute and per-hour aggregates of numerical status values, maintained by `db_admin.py rollup`
+DROP TABLE monitor_rollup_1m CASCADE;
+CREATE TABLE monitor_rollup_1m (
+       time TIMESTAMP,
+       client TEXT,
+       key TEXT,
+       vmin FLOAT8,
+       vmean FLOAT8,
+       vmax FLOAT8,
+       n INTEGER,
+       PRIMARY KEY (client, key, time)
+);
+
+DROP TABLE monitor_rollup_1h CASCADE;
+CREATE TABLE monitor_rollup_1h (
+       time TIMESTAMP,
+       client TEXT,
+       key TEXT,
+       vmin FLOAT8,
+       vmean FLOAT8,
+       vmax FLOAT8,
+       n INTEGER,
+       PRIMARY KEY (client, key, time)
+);
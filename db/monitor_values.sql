@@ -0,0 +1,9 @@
+--- Numerical status values, one row per client variable per snapshot
+DROP TABLE monitor_values CASCADE;
+CREATE TABLE monitor_values (
+       time TIMESTAMP,
+       client TEXT,
+       key TEXT,
+       value FLOAT8
+);
+CREATE INDEX ON monitor_values (client, key, time);
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import re
+import datetime
+import hashlib
+from time import sleep
+
+from db import DB
+from status_export import numeric_regex, buckets_query
+
+
+def backfill_values(db, time1=None, time2=None, days=1.0):
+    """Populate monitor_values table from JSONB snapshots in monitor_status, in chunks of given number of days"""
+    if time1 is None:
+        time1 = db.query('SELECT min(time) FROM monitor_status')
+    if time2 is None:
+        time2 = db.query('SELECT max(time) FROM monitor_status')
+
+    if time1 is None or time2 is None:
+        print("No data in monitor_status")
+        return
+
+    # The lower bound is exclusive below
+    t1 = time1 - datetime.timedelta(microseconds=1)
+
+    while t1 < time2:
+        t2 = min(t1 + datetime.timedelta(days=days), time2)
+
+        with db.cursor() as cur:
+            # Replace whatever is already stored for this interval
+            cur.execute('DELETE FROM monitor_values WHERE time > %s AND time <= %s', (t1, t2))
+            cur.execute('''
+            INSERT INTO monitor_values (time, client, key, value)
+            SELECT ms.time, c.key, v.key, (v.value #>> '{}')::float8
+            FROM monitor_status ms,
+                 jsonb_each(ms.status) c,
+                 jsonb_each(CASE WHEN jsonb_typeof(c.value) = 'object' THEN c.value ELSE '{}'::jsonb END) v
+            WHERE ms.time > %s AND ms.time <= %s AND (v.value #>> '{}') ~ %s
+            ''', (t1, t2, numeric_regex))
+
+            print("%s - %s: %d values" % (t1, t2, cur.rowcount))
+
+        t1 = t2
+
+
+# Definitions of time-partitioned tables: columns, the ones to copy from original table, and indexes to create on the partitioned table
+_partitioned = {
+    'log': {
+        'columns': "id INTEGER NOT NULL DEFAULT nextval('log_id_seq'), time TIMESTAMP NOT NULL, source TEXT, type TEXT DEFAULT 'info', message TEXT, "
+                   "message_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', coalesce(message, ''))) STORED, PRIMARY KEY (id, time)",
+        'copy': 'id, time, source, type, message',
+        'sequence': 'log_id_seq',
+        'indexes': ['(time, id)', '(source, time, id)', 'USING gin (message_tsv)'],
+    },
+    'monitor_status': {
+        'columns': "id INTEGER NOT NULL DEFAULT nextval('monitor_status_id_seq'), time TIMESTAMP NOT NULL, status JSONB, PRIMARY KEY (id, time)",
+        'copy': 'id, time, status',
+        'sequence': 'monitor_status_id_seq',
+        'indexes': ['(time)'],
+    },
+    'monitor_values': {
+        'columns': "time TIMESTAMP NOT NULL, client TEXT, key TEXT, value FLOAT8",
+        'copy': 'time, client, key, value',
+        'sequence': None,
+        'indexes': ['(client, key, time)'],
+    },
+}
+
+
+def month_start(time, shift=0):
+    """Start of the month containing given time, shifted by given number of months"""
+    month = time.year*12 + time.month - 1 + shift
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table, time):
+    return '%s_y%04dm%02d' % (table, time.year, time.month)
+
+
+def is_partitioned(db, table):
+    return db.query("SELECT relkind FROM pg_class WHERE relname = %s AND relkind IN ('r', 'p')", (table,)) == 'p'
+
+
+def list_partitions(db, table):
+    """List of (name, start time) for monthly partitions of the table"""
+    names = db.query('''
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname = %s ORDER BY c.relname
+    ''', (table,), simplify=False) or []
+
+    partitions = []
+    for (name,) in names:
+        try:
+            partitions.append((name, datetime.datetime.strptime(name[len(table):], '_y%Ym%m')))
+        except ValueError:
+            # Default partition
+            pass
+
+    return partitions
+
+
+def create_partitions(db, table, time1, time2):
+    """Create monthly partitions covering given time interval"""
+    time = month_start(time1)
+    while time <= time2:
+        create_partition(db, table, time)
+        time = month_start(time, 1)
+
+
+def create_partition(db, table, time):
+    """Create monthly partition starting at given time, moving its rows out of the default partition if necessary"""
+    name = partition_name(table, time)
+    default = table + '_default'
+    time2 = month_start(time, 1)
+
+    if db.query('SELECT to_regclass(%s) IS NOT NULL', (name,)):
+        return
+
+    if not db.query('SELECT to_regclass(%s) IS NOT NULL', (default,)) or \
+       not db.query('SELECT EXISTS (SELECT 1 FROM %s WHERE time >= %%s AND time < %%s)' % default, (time, time2)):
+        db.query('CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (name, table), (time, time2))
+        return
+
+    # PostgreSQL refuses to create the partition for the rows already in default one,
+    # so we have to detach it, create the partition, move the rows there and attach the default back
+    columns = _partitioned[table]['copy']
+
+    with db.cursor() as cur:
+        cur.execute('BEGIN')
+        try:
+            cur.execute('ALTER TABLE %s DETACH PARTITION %s' % (table, default))
+            cur.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (name, table), (time, time2))
+            cur.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE time >= %%s AND time < %%s' % (table, columns, columns, default), (time, time2))
+            print("%s: %d rows moved from %s to %s" % (table, cur.rowcount, default, name))
+            cur.execute('DELETE FROM %s WHERE time >= %%s AND time < %%s' % default, (time, time2))
+            cur.execute('ALTER TABLE %s ATTACH PARTITION %s DEFAULT' % (table, default))
+            cur.execute('COMMIT')
+        except:
+            cur.execute('ROLLBACK')
+            raise
+
+
+def partition_table(db, table, months_ahead=3, drop_old=False):
+    """Convert plain table to the one partitioned by month, copying the data from it"""
+    if is_partitioned(db, table):
+        print("%s is already partitioned" % table)
+        return
+
+    spec = _partitioned[table]
+    old = table + '_old'
+    now = datetime.datetime.utcnow()
+
+    with db.cursor() as cur:
+        # Everything in a single transaction, so that the table is either converted or left intact
+        cur.execute('BEGIN')
+        try:
+            cur.execute('LOCK TABLE %s IN EXCLUSIVE MODE' % table)
+            cur.execute('ALTER TABLE %s RENAME TO %s' % (table, old))
+
+            # Plot indexes are re-created on the new table by `indexes` command, and should not occupy their names
+            cur.execute("""SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                           WHERE i.indrelid = %s::regclass AND c.relname LIKE %s""", (old, _status_index_prefix + '%'))
+            for (name,) in cur.fetchall():
+                cur.execute('DROP INDEX %s' % name)
+            cur.execute('CREATE TABLE %s (%s) PARTITION BY RANGE (time)' % (table, spec['columns']))
+            cur.execute('CREATE TABLE %s_default PARTITION OF %s DEFAULT' % (table, table))
+
+            cur.execute('SELECT min(time) FROM %s' % old)
+            time1 = cur.fetchone()[0] or now
+
+            time = month_start(time1)
+            while time <= month_start(now, months_ahead):
+                cur.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)' % (partition_name(table, time), table),
+                            (time, month_start(time, 1)))
+                time = month_start(time, 1)
+
+            cur.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE time IS NOT NULL' % (table, spec['copy'], spec['copy'], old))
+            print("%s: %d rows copied" % (table, cur.rowcount))
+
+            for index in spec['indexes']:
+                cur.execute('CREATE INDEX ON %s %s' % (table, index))
+
+            if spec['sequence']:
+                cur.execute('ALTER SEQUENCE %s OWNED BY %s.id' % (spec['sequence'], table))
+
+            if drop_old:
+                cur.execute('DROP TABLE %s' % old)
+            else:
+                print("Original table is kept as %s, rows with NULL time are not copied" % old)
+
+            cur.execute('COMMIT')
+        except:
+            cur.execute('ROLLBACK')
+            raise
+
+
+def apply_retention(db, table, keep_months, detach=False):
+    """Drop or detach the partitions older than given number of months"""
+    cutoff = month_start(datetime.datetime.utcnow(), -keep_months)
+
+    for name, time in list_partitions(db, table):
+        if month_start(time, 1) <= cutoff:
+            if detach:
+                db.query('ALTER TABLE %s DETACH PARTITION %s' % (table, name))
+                print("%s: partition %s detached" % (table, name))
+            else:
+                db.query('DROP TABLE %s' % name)
+                print("%s: partition %s dropped" % (table, name))
+
+
+def maintain_partitions(db, months_ahead=3, keep_months=None, detach=False):
+    """Create future partitions and apply the retention for all partitioned tables"""
+    now = datetime.datetime.utcnow()
+
+    for table in _partitioned:
+        if not is_partitioned(db, table):
+            continue
+
+        create_partitions(db, table, now, month_start(now, months_ahead))
+
+        if keep_months:
+            apply_retention(db, table, keep_months, detach=detach)
+
+
+# Rollup tables: (table, date_trunc unit, bucket length, source table, aggregates over the source)
+_rollups = [
+    ('monitor_rollup_1m', 'minute', datetime.timedelta(minutes=1), 'monitor_values',
+     'min(value), avg(value), max(value), count(value)'),
+    ('monitor_rollup_1h', 'hour', datetime.timedelta(hours=1), 'monitor_rollup_1m',
+     'min(vmin), sum(vmean*n)/nullif(sum(n), 0), max(vmax), sum(n)'),
+]
+
+
+def update_rollups(db, time1=None, days=1.0):
+    """Aggregate complete time buckets not yet present in rollup tables, or all buckets since time1"""
+    now = datetime.datetime.utcnow()
+
+    for table, unit, period, source, aggregates in _rollups:
+        # Only complete buckets are aggregated
+        end = db.query("SELECT date_trunc(%s, %s)", (unit, now))
+
+        start = time1
+        if start is None:
+            last = db.query('SELECT max(time) FROM %s' % table)
+            start = last + period if last else db.query('SELECT date_trunc(%%s, min(time)) FROM %s' % source, (unit,))
+
+        if start is None:
+            continue
+
+        t1 = start
+        while t1 < end:
+            t2 = min(t1 + datetime.timedelta(days=days), end)
+
+            with db.cursor() as cur:
+                cur.execute('''
+                INSERT INTO %s (time, client, key, vmin, vmean, vmax, n)
+                SELECT date_trunc(%%s, time) AS bucket, client, key, %s
+                FROM %s WHERE time >= %%s AND time < %%s
+                GROUP BY bucket, client, key
+                ON CONFLICT (client, key, time) DO UPDATE
+                SET vmin = EXCLUDED.vmin, vmean = EXCLUDED.vmean, vmax = EXCLUDED.vmax, n = EXCLUDED.n
+                ''' % (table, aggregates, source), (unit, t1, t2))
+
+                print("%s: %s - %s: %d buckets" % (table, t1, t2, cur.rowcount))
+
+            t1 = t2
+
+
+def plot_variables(filename):
+    """List of (client, key) for all variables plotted by enabled clients in monitor config file"""
+    from configobj import ConfigObj, Section
+
+    conf = ConfigObj(filename)
+    variables = []
+
+    for cname in conf:
+        section = conf[cname]
+        if type(section) != Section or str(section.get('enabled', True)).lower() in ['false', 'no', 'off', '0']:
+            continue
+
+        for plot in section.get('plots', {}).values():
+            values = plot.get('values', [])
+            if not isinstance(values, list):
+                values = values.split(',')
+
+            for key in values:
+                key = key.strip()
+                if key and key != 'time' and (cname, key) not in variables:
+                    variables.append((cname, key))
+
+    return variables
+
+
+def status_expression(client, key):
+    """The expression archive uses to extract the status value, should match archive.views_status"""
+    return "(status #> '{%s}' #>> '{%s}')" % (client, key)
+
+
+def status_index_name(client, key):
+    name = re.sub(r'[^a-z0-9_]', '_', ('%s_%s' % (client, key)).lower())
+    if len(name) > 40:
+        # PostgreSQL limits identifiers to 63 characters
+        name = name[:30] + '_' + hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+
+    return _status_index_prefix + name
+
+
+# Prefix of the indexes managed by update_status_indexes()
+_status_index_prefix = 'monitor_status_plot_'
+
+
+def update_status_indexes(db, filename, drop=False, dry_run=False):
+    """
+    Create partial indexes on monitor_status(time) for the rows containing every plotted variable,
+    optionally dropping the ones for variables not plotted anymore, and report which queries would use them
+    """
+    variables = plot_variables(filename)
+    wanted = {status_index_name(client, key): (client, key) for client, key in variables}
+
+    existing = db.query("""SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                           WHERE i.indrelid = 'monitor_status'::regclass AND c.relname LIKE %s""",
+                        (_status_index_prefix + '%',), simplify=False) or []
+    existing = [_[0] for _ in existing]
+
+    # Indexes on partitioned table may not be created or dropped concurrently, so writes are blocked while it is running
+    concurrently = '' if is_partitioned(db, 'monitor_status') else 'CONCURRENTLY '
+
+    for name, (client, key) in wanted.items():
+        if name not in existing:
+            if db.query('SELECT to_regclass(%s) IS NOT NULL', (name,)):
+                print("%s.%s: index name %s is already used by another relation, skipping it" % (client, key, name))
+                continue
+
+            sql = 'CREATE INDEX %s%s ON monitor_status (time) WHERE %s IS NOT NULL' % (concurrently, name, status_expression(client, key))
+            print(sql)
+            if not dry_run:
+                db.query(sql)
+
+    if drop:
+        for name in existing:
+            if name not in wanted:
+                sql = 'DROP INDEX %sIF EXISTS %s' % (concurrently, name)
+                print(sql)
+                if not dry_run:
+                    db.query(sql)
+
+    # Check which archive queries would use the indexes, using the query of a day long plot
+    time2 = datetime.datetime.utcnow()
+    time1 = time2 - datetime.timedelta(days=1)
+
+    for name, (client, key) in wanted.items():
+        plan = db.query('EXPLAIN ' + buckets_query(['%s.%s' % (client, key)]), (time1, 86400/1000, time1, time2), simplify=False) or []
+        plan = "\n".join([_[0] for _ in plan])
+
+        # On partitioned table, the plan mentions the indexes of partitions attached to ours
+        names = [name] + [_[0] for _ in db.query("""SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                                                    WHERE i.inhparent = to_regclass(%s)""", (name,), simplify=False) or []]
+        used = any([re.search(r'\b%s\b' % re.escape(_), plan) for _ in names])
+
+        print("%s.%s: archive plot query %s" % (client, key, "uses %s" % name if used else "does not use the index"))
+
+
+def parse_time(string):
+    return datetime.datetime.strptime(string, '%Y-%m-%d %H:%M:%S' if ' ' in string else '%Y-%m-%d') if string else None
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="""usage: %prog [options] command
+
+Commands:
+  backfill - populate monitor_values table from monitor_status JSONB snapshots
+  partition table - convert the table (log, monitor_status or monitor_values) to monthly partitions
+  maintain - create future partitions and apply retention, to be run daily from cron
+  rollup - update per-minute and per-hour rollup tables from monitor_values
+  indexes - create monitor_status indexes for variables plotted in monitor config, and report their usage
+  sync - copy the data stored by monitor to local SQLite database into PostgreSQL""")
+    parser.add_option('-d', '--db-host', help='Database server host', action='store', dest='db_host', type='string', default='')
+    parser.add_option('-f', '--from', help='Start time, YYYY-MM-DD [HH:MM:SS]', action='store', dest='time1', type='string', default=None)
+    parser.add_option('-t', '--to', help='End time, YYYY-MM-DD [HH:MM:SS]', action='store', dest='time2', type='string', default=None)
+    parser.add_option('--days', help='Number of days to process at once', action='store', dest='days', type='float', default=1.0)
+    parser.add_option('--months-ahead', help='Number of future monthly partitions to create', action='store', dest='months_ahead', type='int', default=3)
+    parser.add_option('--keep-months', help='Number of monthly partitions to keep', action='store', dest='keep_months', type='int', default=None)
+    parser.add_option('--detach', help='Detach old partitions instead of dropping them', action='store_true', dest='detach', default=False)
+    parser.add_option('-l', '--loop', help='Repeat the rollup update or sync every given number of seconds', action='store', dest='loop', type='float', default=0)
+    parser.add_option('-c', '--config', help='Monitor config file', action='store', dest='config', type='string',
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor.ini'))
+    parser.add_option('-L', '--db-path', help='Local SQLite database file', action='store', dest='db_path', type='string',
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor.sqlite'))
+    parser.add_option('--drop', help='Drop the indexes for variables not plotted anymore', action='store_true', dest='drop', default=False)
+    parser.add_option('-n', '--dry-run', help='Only print the statements to be executed', action='store_true', dest='dry_run', default=False)
+    parser.add_option('--drop-old', help='Drop the original table after partitioning', action='store_true', dest='drop_old', default=False)
+
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.error("Command should be given")
+
+    db = DB(dbhost=options.db_host)
+
+    if args[0] == 'backfill':
+        backfill_values(db, parse_time(options.time1), parse_time(options.time2), days=options.days)
+    elif args[0] == 'partition' and len(args) > 1 and args[1] in _partitioned:
+        partition_table(db, args[1], months_ahead=options.months_ahead, drop_old=options.drop_old)
+    elif args[0] == 'rollup':
+        update_rollups(db, parse_time(options.time1), days=options.days)
+
+        while options.loop > 0:
+            sleep(options.loop)
+            update_rollups(db, days=options.days)
+    elif args[0] == 'indexes':
+        update_status_indexes(db, options.config, drop=options.drop, dry_run=options.dry_run)
+    elif args[0] == 'sync':
+        from db_local import LocalDB
+        local = LocalDB(options.db_path)
+        local.sync(db)
+
+        while options.loop > 0:
+            sleep(options.loop)
+            local.sync(db)
+    elif args[0] == 'maintain':
+        maintain_partitions(db, months_ahead=options.months_ahead, keep_months=options.keep_months, detach=options.detach)
+    else:
+        parser.error("Unknown command: %s" % " ".join(args))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+import numpy as np
+import psycopg2.extras
+
+from db import DB
+
+# Synthetic extract of monitor_status, one row per snapshot with a few typical values
+_extract = '''
+SELECT '2020-01-01'::timestamp + i * interval '1 second' AS time,
+       (-100 + sin(i/1000.0))::float8 AS temperature,
+       (1e-6 * (1 + i %% 7))::float8 AS pressure,
+       (i %% 2)::int AS connected,
+       'cryo-con' AS client
+FROM generate_series(1, %s) AS i
+'''
+
+
+def query_rowwise(db, string, data):
+    """Original row-by-row filling of the record array from DictCursor, for comparison"""
+    with db.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute(string, data)
+        result = cur.fetchall()
+
+        strLength = 10
+        __pgTypeHash = {16:bool, 18:str, 20:'i8', 21:'i2', 23:'i4', 25:'|S%d'%strLength, 700:'f4', 701:'f8',
+                        1042:'|S%d'%strLength, 1043:'|S%d'%strLength, 1700:'f8'}
+
+        names = [d.name for d in cur.description]
+        formats = [__pgTypeHash.get(d.type_code, '|O') for d in cur.description]
+
+        table = np.recarray(shape=(cur.rowcount,), formats=formats, names=names)
+
+        for i,v in enumerate(result):
+            table[i] = tuple(v)
+
+        return table
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-d', '--db-host', help='Database server host', action='store', dest='db_host', type='string', default='')
+    parser.add_option('-N', '--nrows', help='Number of rows', action='store', dest='nrows', type='int', default=1000000)
+    parser.add_option('-r', '--rowwise', help='Also time the original row-wise loading', action='store_true', dest='rowwise', default=False)
+    parser.add_option('-s', '--streaming', help='Also time the streaming loading in chunks of given size', action='store', dest='streaming', type='int', default=0)
+
+    (options, args) = parser.parse_args()
+
+    db = DB(dbhost=options.db_host)
+
+    t0 = time.time()
+    table = db.query(_extract, (options.nrows,), array=True)
+    print("Columnar loading of %d rows: %.2f s" % (len(table), time.time() - t0))
+
+    if options.rowwise:
+        t0 = time.time()
+        table = query_rowwise(db, _extract, (options.nrows,))
+        print("Row-wise loading of %d rows: %.2f s" % (len(table), time.time() - t0))
+
+    if options.streaming:
+        t0 = time.time()
+        nrows = 0
+        for chunk in db.iter_query(_extract, (options.nrows,), chunk=options.streaming, array=True):
+            nrows += len(chunk)
+        print("Streaming loading of %d rows in chunks of %d: %.2f s" % (nrows, options.streaming, time.time() - t0))
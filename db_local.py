@@ -0,0 +1,221 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sqlite3
+import datetime
+import time
+import json
+import threading
+
+import numpy as np
+
+from db import BaseDB, status_values
+
+class LocalDB(BaseDB):
+    """Embedded storage in local SQLite database, with the same interface as DB, for the setups without PostgreSQL.
+    The writes are accumulated in memory and committed in batches, and may be later copied to PostgreSQL with sync()"""
+    # Tables with the columns matching the ones in PostgreSQL
+    _tables = [
+        ('log', 'time, source, type, message'),
+        ('monitor_status', 'time, status'),
+        ('monitor_values', 'time, client, key, value'),
+    ]
+
+    _schema = [
+        "CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY KEY, time TEXT, source TEXT, type TEXT DEFAULT 'info', message TEXT)",
+        "CREATE INDEX IF NOT EXISTS log_time_idx ON log (time)",
+        "CREATE TABLE IF NOT EXISTS monitor_status (id INTEGER PRIMARY KEY, time TEXT, status TEXT)",
+        "CREATE INDEX IF NOT EXISTS monitor_status_time_idx ON monitor_status (time)",
+        "CREATE TABLE IF NOT EXISTS monitor_values (time TEXT, client TEXT, key TEXT, value REAL)",
+        "CREATE INDEX IF NOT EXISTS monitor_values_idx ON monitor_values (client, key, time)",
+        # Last row copied to PostgreSQL for every table
+        "CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, last_id INTEGER)",
+    ]
+
+    # Pending writes are committed when either the number of rows or the time since last commit exceeds these limits.
+    # The latter is also checked by start(), so that the rows do not stay in memory if no more writes arrive
+    batch_size = 1000
+    batch_interval = 10.0
+
+    store_values = True
+
+    def __init__(self, filename='monitor.sqlite'):
+        BaseDB.__init__(self)
+
+        self.filename = filename
+
+        # Single connection shared between threads, protected by the lock
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.RLock()
+
+        # WAL journal allows reading the database while it is being written, and makes commits cheap
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        for sql in self._schema:
+            self.conn.execute(sql)
+        self.conn.commit()
+
+        self._pending = {table: [] for table,_ in self._tables}
+        self._npending = 0
+        self._flushed = time.time()
+
+    def start(self, reactor):
+        """Periodically commit pending writes from the reactor"""
+        from twisted.internet.task import LoopingCall
+
+        def check():
+            if self._npending and time.time() - self._flushed >= self.batch_interval:
+                self.deferFlush().addErrback(lambda failure: failure.printTraceback())
+
+        self._timer = LoopingCall(check)
+        self._timer.clock = reactor
+        self._timer.start(self.batch_interval/2, now=False)
+
+    def close(self):
+        if getattr(self, '_timer', None) is not None and self._timer.running:
+            self._timer.stop()
+
+        with self._lock:
+            self.flush()
+            self.conn.close()
+
+    def _time(self, time):
+        """Timestamps are stored as ISO strings, which sort properly and are understood by PostgreSQL"""
+        if time is None:
+            time = datetime.datetime.utcnow()
+
+        return time.isoformat(' ')
+
+    def _append(self, table, rows):
+        with self._lock:
+            self._pending[table] += rows
+            self._npending += len(rows)
+
+            if self._npending >= self.batch_size or time.time() - self._flushed > self.batch_interval:
+                self.flush()
+
+    def flush(self):
+        """Commit all pending writes in a single transaction"""
+        with self._lock:
+            with self.conn:
+                for table,columns in self._tables:
+                    if self._pending[table]:
+                        self.conn.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table, columns, ', '.join(['?']*len(columns.split(',')))),
+                                              self._pending[table])
+                        self._pending[table] = []
+
+            self._npending = 0
+            self._flushed = time.time()
+
+    def query(self, string="", data=(), simplify=True, debug=False, array=False):
+        """Run the query, using the same %s placeholders as DB.query"""
+        string = string.replace('%s', '?')
+
+        if debug:
+            print(string, data)
+
+        with self._lock:
+            # Pending writes should be visible to the query
+            self.flush()
+
+            with self.conn:
+                cur = self.conn.execute(string, data)
+
+                if cur.description is None:
+                    return None
+
+                result = cur.fetchall()
+
+        if array:
+            names = [d[0] for d in cur.description]
+            columns = []
+            for values in (zip(*result) if result else [()]*len(names)):
+                try:
+                    # NULLs become NaNs
+                    columns.append(np.array(values, dtype=float))
+                except (TypeError, ValueError):
+                    columns.append(np.array(values, dtype=object))
+
+            return np.rec.fromarrays(columns, names=names)
+
+        # Simplify the result if it is simple
+        if simplify and len(result) == 1:
+            if len(result[0]) == 1:
+                return result[0][0]
+            else:
+                return result[0]
+        else:
+            return result
+
+    def log(self, message, time=None, source=None, type='info'):
+        """Store message to log table. Time is assumed to be in UTC scale, default to present moment."""
+        self._append('log', [(self._time(time), source or '', type, message)])
+
+    def store_status(self, status, time=None):
+        """Store monitor status dictionary, or its JSON string, to monitor_status and monitor_values tables"""
+        time = self._time(time)
+
+        if isinstance(status, dict):
+            string = json.dumps(status)
+        else:
+            string, status = status, json.loads(status)
+
+        self._append('monitor_status', [(time, string)])
+
+        if self.store_values:
+            self._append('monitor_values', [(time,) + _ for _ in status_values(status)])
+
+    def sync(self, db, chunk=10000):
+        """Copy the rows not yet copied to PostgreSQL database db, in chunks of given size"""
+        import psycopg2.extras, psycopg2.errors
+
+        self.flush()
+
+        for table,columns in self._tables:
+            ncolumns = len(columns.split(','))
+            # JSON strings should be explicitly converted to JSONB
+            template = '(%s, %s::jsonb)' if table == 'monitor_status' else '(%s)' % ', '.join(['%s']*ncolumns)
+            nrows = 0
+
+            while True:
+                with self._lock:
+                    last_id = self.conn.execute('SELECT last_id FROM sync_state WHERE name = ?', (table,)).fetchone()
+                    last_id = last_id[0] if last_id else 0
+
+                    rows = self.conn.execute('SELECT rowid, %s FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?' % (columns, table),
+                                             (last_id, chunk)).fetchall()
+
+                if not rows:
+                    break
+
+                try:
+                    self._sync_rows(db, table, columns, template, rows)
+                except psycopg2.errors.UndefinedTable:
+                    print("No %s table in PostgreSQL, skipping it" % table)
+                    break
+
+                nrows += len(rows)
+
+            print("%s: %d rows copied" % (table, nrows))
+
+    def _sync_rows(self, db, table, columns, template, rows):
+        """Insert the rows into PostgreSQL and advance the sync state so that either both happen or none.
+        Local state is updated inside the PostgreSQL transaction and committed right after it, so that only the failure
+        of local commit after successful remote one (which is very unlikely) may cause the rows to be copied again"""
+        import psycopg2.extras
+
+        with db.cursor() as cur:
+            cur.execute('BEGIN')
+
+            with self._lock:
+                try:
+                    psycopg2.extras.execute_values(cur, 'INSERT INTO %s (%s) VALUES %%s' % (table, columns), [_[1:] for _ in rows], template=template)
+                    self.conn.execute('INSERT OR REPLACE INTO sync_state (name, last_id) VALUES (?, ?)', (table, rows[-1][0]))
+                    cur.execute('COMMIT')
+                except:
+                    self.conn.rollback()
+                    if not cur.connection.closed:
+                        cur.execute('ROLLBACK')
+                    raise
+
+                self.conn.commit()
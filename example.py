@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import startup_profile
+
 import os, sys
 
 from daemon import SimpleFactory, SimpleProtocol
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import startup_profile
+
 import os
 import sys
 import time
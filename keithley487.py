@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import startup_profile
+
 from daemon import SimpleFactory, SimpleProtocol, catch
 import datetime
 from command import Command
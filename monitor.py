@@ -2,12 +2,15 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import startup_profile
+
 from twisted.internet import stdio
 from twisted.protocols.basic import LineReceiver
 from twisted.web.server import Site
 from twisted.web.resource import Resource
 from twisted.web.static import File
 from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.task import LoopingCall
 
 try:
     from txsockjs.factory import SockJSResource
@@ -22,6 +25,8 @@ import sys
 import posixpath
 import datetime
 import re
+import operator
+import fnmatch
 
 try:
     # Python2
@@ -34,38 +39,199 @@ except:
     from io import BytesIO, StringIO
 
 import json
-import numpy as np
 
 from collections import OrderedDict
 
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-from matplotlib.dates import DateFormatter
-from matplotlib.ticker import ScalarFormatter, LogLocator, LinearLocator, MaxNLocator, NullLocator
-
 from daemon import SimpleFactory, SimpleProtocol
 from command import Command
 from daemon import catch
-from db import DB
 
 
 def kwargsToString(kwargs, prefix=''):
     return " ".join([prefix + _ + '=' + kwargs[_] for _ in kwargs])
 
 
+class WaitCondition:
+    """
+    Condition on a single client.key status value, waited for by a peer using
+    wait_for client.key<value [timeout=sec] [stable=sec] [hysteresis=delta] [id=id]
+    """
+    _options = ['timeout', 'stable', 'hysteresis', 'id']
+    _operators = OrderedDict([('<=', operator.le), ('>=', operator.ge), ('==', operator.eq), ('!=', operator.ne),
+                              ('<', operator.lt), ('>', operator.gt)])
+
+    def __init__(self, protocol, chunks, id=None):
+        self.protocol = protocol
+
+        # Options are kwargs from the list below, everything else is the condition, possibly with spaces
+        options = {}
+        condition = []
+        for chunk in chunks:
+            key, _, value = chunk.partition('=')
+            if key in self._options and value:
+                options[key] = value
+            else:
+                condition.append(chunk)
+
+        self.condition = "".join(condition)
+        self.id = options.get('id', id)
+        self.timeout = float(options.get('timeout', 0))
+        self.stable = float(options.get('stable', 0))
+        self.hysteresis = float(options.get('hysteresis', 0))
+
+        m = re.match(r'^([a-zA-Z0-9_\-]+)\.([a-zA-Z0-9_\-.]+)(<=|>=|==|!=|<|>)(.+)$', self.condition)
+        if not m:
+            raise ValueError("Can't parse condition: %s" % self.condition)
+
+        self.client, self.key, op, threshold = m.group(1, 2, 3, 4)
+        self.predicate = self.compile(op, threshold)
+
+        self._holds = False  # Whether the condition holds now
+        self._since = None  # Since when it holds
+        self.timer = None
+        self.value = None
+
+    def compile(self, op, threshold):
+        """Build the predicate function of the value, with hysteresis applied if the condition already holds"""
+        func = self._operators[op]
+
+        try:
+            threshold = float(threshold)
+        except ValueError:
+            # String comparison, equality only
+            if op not in ['==', '!=']:
+                raise ValueError("Non-numerical threshold for %s: %s" % (op, threshold))
+            return lambda value, holds: func(value, threshold)
+
+        # Relaxed thresholds to stay in the state once it is reached
+        if op in ['<', '<=']:
+            relaxed = threshold + self.hysteresis
+        elif op in ['>', '>=']:
+            relaxed = threshold - self.hysteresis
+        else:
+            relaxed = threshold
+
+        def predicate(value, holds):
+            try:
+                value = float(value)
+            except (ValueError, TypeError):
+                return False
+
+            return func(value, relaxed if holds else threshold)
+
+        return predicate
+
+    def check(self, status, now):
+        """Update the state using new client status, return True if the condition is stably satisfied"""
+        self.value = status.get(self.key)
+        holds = self.value is not None and self.predicate(self.value, self._holds)
+
+        if holds and not self._holds:
+            self._since = now
+        self._holds = holds
+
+        return holds and now - self._since >= self.stable
+
+
+class Subscription:
+    """
+    Subscription of a peer to the changes of status values, requested using
+    subscribe keys=client.key,client.key* [rate=updates_per_second]
+    """
+
+    def __init__(self, protocol, keys, rate=0):
+        self.protocol = protocol
+        self.keys = [_ for _ in keys.split(',') if _]
+
+        try:
+            rate = float(rate or 0)
+        except ValueError:
+            raise ValueError("Rate should be a number: %s" % rate)
+
+        self.interval = 1.0/rate if rate > 0 else 0
+
+        # Client names the subscription should be indexed by, or '*' for patterns with wildcard client name
+        self.clients = set()
+        for key in self.keys:
+            client = key.split('.', 1)[0]
+            self.clients.add('*' if re.search(r'[*?\[]', client) else client)
+
+        self.regex = re.compile('|'.join([fnmatch.translate(_) for _ in self.keys]))
+
+        self._matches = {}  # Cache of matching results for client.key strings
+        self._sent = {}  # Values already sent to the peer
+        self._pending = OrderedDict()  # Changed values waiting to be sent
+        self._last = None  # Time of last update sent
+        self.timer = None
+
+    def matches(self, key):
+        if key not in self._matches:
+            self._matches[key] = self.regex.match(key) is not None
+
+        return self._matches[key]
+
+    def update(self, client, status, reactor):
+        """Queue the changed matching values of client status, and send them if rate limit allows"""
+        for key, value in status.items():
+            key = client + '.' + key
+            if self.matches(key) and self._sent.get(key) != value:
+                self._pending[key] = value
+
+        if not self._pending or (self.timer and self.timer.active()):
+            return
+
+        now = reactor.seconds()
+        if self._last is None or now - self._last >= self.interval:
+            self.flush(reactor)
+        else:
+            self.timer = reactor.callLater(self._last + self.interval - now, self.flush, reactor)
+
+    def flush(self, reactor):
+        if self._pending:
+            self.protocol.message('update ' + kwargsToString(self._pending))
+            self._sent.update(self._pending)
+            self._pending = OrderedDict()
+            self._last = reactor.seconds()
+
+    def cancel(self):
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+
+
 class MonitorProtocol(SimpleProtocol):
     _debug = False
+    # Tick of the polling scheduler, actual per-client intervals are set in update()
+    _refresh = 0.1
+
+    # Default polling parameters, may be overridden for every client in config file
+    _poll_refresh = 1.0  # Interval between get_status requests, in seconds
+    _poll_timeout = 10.0  # Time to wait for the status reply before considering it lost
+    _poll_refresh_max = 60.0  # Longest interval the polling may slow down to
+    _poll_history = 1000  # Number of points to keep in plot history
 
     def __init__(self):
         SimpleProtocol.__init__(self)
         self.name = None
         self.status = {}
 
+        # Polling state
+        self._poll_interval = None  # Current interval, grows for timed out clients
+        self._poll_sent = None  # Time of the outstanding get_status, or None
+        self._poll_next = 0  # Earliest time to send the next get_status
+        self._poll_rtt = None  # Round-trip time of the last get_status
+        self._poll_timeouts = 0  # Number of consecutive timeouts
+        self._poll_late = None  # Time of the last timed out get_status, its reply may still arrive
+        self._poll_extra = 0  # Number of consecutive status messages received with no request outstanding
+        self._poll_unsolicited = False  # Whether the client sends status messages we did not request
+
+        # Flattened status last sent to the peer as a delta
+        self._delta_status = None
+
     @catch
     def connectionMade(self):
         SimpleProtocol.connectionMade(self)
 
-        self.message('id name=monitor')  # Send our identity to the peer
+        self.message('id name=%s type=monitor' % self.object['name'])  # Send our identity to the peer
         self.message('get_id')  # Request peer identity
 
     @catch
@@ -74,6 +240,9 @@ class MonitorProtocol(SimpleProtocol):
             self.log("%s disconnected" % self.name, type='info')
             # print "Disconnected:", self.name
 
+        self.factory.cancelWaits(self)
+        self.factory.unsubscribe(self)
+
         SimpleProtocol.connectionLost(self, reason)
 
     @catch
@@ -81,6 +250,11 @@ class MonitorProtocol(SimpleProtocol):
         if self._debug:
             print("%s:%d > %s" % (self._peer.host, self._peer.port, string))
 
+        if string.startswith('status_delta '):
+            # JSON payload, should not be split by Command parser
+            self.processStatusDelta(json.loads(string[len('status_delta '):]))
+            return
+
         cmd = Command(string)
 
         if cmd.name == 'id':
@@ -94,54 +268,18 @@ class MonitorProtocol(SimpleProtocol):
         elif cmd.name == 'status':
             # We keep var=value pairs from the status to report it to clients
             self.status = cmd.kwargs
-
-            # We have to keep the history of values for some variables for plots
-            if self.name in self.object['values']:
-                for name in self.object['values'][self.name]:
-                    if name == 'time':
-                        value = datetime.datetime.utcnow()
-                    else:
-                        value = self.status.get(name, None)
-                        # Now we should try to convert the value to numerical form, if possible
-                        try:
-                            value = float(value)
-                        except:
-                            pass
-
-                    self.object['values'][self.name][name].append(value)
-                    # Keep the maximal length of data arrays limited
-                    # TODO: make it configurable, probably for every plot
-                    if len(self.object['values'][self.name][name]) > 1000:
-                        self.object['values'][self.name][name] = self.object['values'][self.name][name][100:]
-
-            # Broadcast new values to all CCDs, if the client itself is not CCD
-            if self.type != 'ccd':
-                self.factory.messageAll("set_keywords " + " ".join([self.name+'.'+_+'=\"' +
-                                                                    self.status[_]+'\"' for _ in self.status.keys()]), type="ccd")
-
-            # Store the values to database, if necessary
-            if 'db' in self.object and self.object['db'] is not None:
-                if (datetime.datetime.utcnow() - self.object['db_status_timestamp']).total_seconds() > self.object['db_status_interval']:
-                    # FIXME: should we also store the status if no peer is reporting at all?
-                    # print "Storing the state to DB"
-
-                    time = datetime.datetime.utcnow()
-                    status = self.factory.getStatus(as_dict=True)
-                    self.object['db'].query('INSERT INTO monitor_status (time, status) VALUES (%s,%s)', (time, status))
-
-                    self.object['db_status_timestamp'] = datetime.datetime.utcnow()
-                    pass
+            self.processStatus()
 
         elif cmd.name == 'get_status':
             if cmd.kwargs.get('format', 'plain') == 'json':
                 self.message('status_json ' + json.dumps(self.factory.getStatus(as_dict=True)))
+            elif cmd.kwargs.get('format', 'plain') == 'delta':
+                self.message('status_delta ' + json.dumps(self.getStatusDelta()))
             else:
                 self.message(self.factory.getStatus())
 
         elif cmd.name == 'send' and cmd.chunks[1]:
-            c = self.factory.findConnection(name=cmd.chunks[1])
-            if c:
-                c.message(" ".join(cmd.chunks[2:]))
+            self.factory.sendCommand(cmd.chunks[1], " ".join(cmd.chunks[2:]))
 
         elif cmd.name in ['debug', 'info', 'message', 'error', 'warning', 'success']:
             msg = " ".join(cmd.chunks[1:])
@@ -150,15 +288,177 @@ class MonitorProtocol(SimpleProtocol):
         elif cmd.name == 'reset_plots':
             self.factory.reset_plots()
 
+        elif cmd.name == 'reload_config':
+            self.factory.reloadConfig()
+
+        elif cmd.name == 'get_poll':
+            self.message('poll ' + kwargsToString(self.factory.getPollStats()))
+
+        elif cmd.name == 'wait_for':
+            try:
+                self.factory.addWait(WaitCondition(self, cmd.chunks[1:]))
+            except ValueError as e:
+                self.message('wait_for_error %s' % e)
+
+        elif cmd.name == 'wait_cancel':
+            self.factory.cancelWaits(self, id=cmd.get('id'))
+
+        elif cmd.name == 'subscribe' and cmd.get('keys'):
+            try:
+                self.factory.subscribe(Subscription(self, cmd.get('keys'), rate=cmd.get('rate', 0)))
+            except ValueError as e:
+                self.message('subscribe_error %s' % e)
+
+        elif cmd.name == 'unsubscribe':
+            self.factory.unsubscribe(self)
+
+    def processStatusDelta(self, delta):
+        """Apply the status delta from downstream monitor"""
+        for key in delta.get('del', []):
+            self.status.pop(key, None)
+
+        self.status.update(delta.get('set', {}))
+        self.processStatus()
+
+    def getStatusDelta(self):
+        """Changes of our flattened status since the last delta sent to this peer"""
+        status = self.factory.getFlatStatus()
+        previous = self._delta_status or {}
+
+        delta = {'set': {_: status[_] for _ in status if previous.get(_) != status[_]},
+                 'del': [_ for _ in previous if _ not in status]}
+
+        self._delta_status = status
+
+        return delta
+
+    def processStatus(self):
+        """Handle the new status of the client - update the history, broadcast to CCDs and store to DB"""
+        if self._poll_sent is not None or self._poll_late is not None:
+            # Reply to our pending or timed out get_status, so the client is healthy again
+            now = self.factory._reactor.seconds()
+            sent = self._poll_sent if self._poll_sent is not None else self._poll_late
+            # Round-trip time is meaningless for the clients pushing their status on their own,
+            # as their unsolicited messages may not be told apart from the replies
+            self._poll_rtt = None if self._poll_unsolicited else now - sent
+            self._poll_sent = None
+            self._poll_late = None
+            self._poll_extra = 0
+            self._poll_timeouts = 0
+            self._poll_interval = self.pollConfig('refresh')
+            # Do not wait for the slowed down schedule anymore
+            self._poll_next = min(self._poll_next, now + self._poll_interval)
+        elif self.name in self.object['clients'] and self._poll_interval is not None:
+            # Status we did not ask for, it should not change the polling state.
+            # Single extra message may be a duplicate reply, but repeated ones mean the client pushes its status
+            self._poll_extra += 1
+            if self._poll_extra > 1:
+                self._poll_unsolicited = True
+                self._poll_rtt = None
+
+        # We have to keep the history of values for some variables for plots
+        if self.name in self.object['values']:
+            for name in self.object['values'][self.name]:
+                if name == 'time':
+                    value = datetime.datetime.utcnow()
+                else:
+                    value = self.status.get(name, None)
+                    # Now we should try to convert the value to numerical form, if possible
+                    try:
+                        value = float(value)
+                    except:
+                        pass
+
+                self.object['values'][self.name][name].append(value)
+                # Keep the maximal length of data arrays limited, dropping 10% of oldest points at once
+                history = self.pollConfig('history')
+                if len(self.object['values'][self.name][name]) > history:
+                    del self.object['values'][self.name][name][:-history + history//10]
+
+        # Broadcast new values to all CCDs, if the client itself is not CCD
+        if self.type != 'ccd':
+            self.factory.messageAll("set_keywords " + " ".join([self.name+'.'+_+'=\"' +
+                                                                self.status[_]+'\"' for _ in self.status.keys()]), type="ccd")
+
+        # Store the values to database, if necessary
+        if 'db' in self.object and self.object['db'] is not None:
+            if (datetime.datetime.utcnow() - self.object['db_status_timestamp']).total_seconds() > self.object['db_status_interval']:
+                # FIXME: should we also store the status if no peer is reporting at all?
+                # print "Storing the state to DB"
+
+                time = datetime.datetime.utcnow()
+                status = self.factory.getStatus(as_dict=True)
+                # Store it in a thread so that slow DB does not block the monitor
+                self.object['db'].deferStoreStatus(status, time=time).addErrback(lambda failure: failure.printTraceback())
+
+                self.object['db_status_timestamp'] = datetime.datetime.utcnow()
+                pass
+
+        # Check the conditions the peers are waiting for
+        if self.name in self.object['waits']:
+            self.factory.checkWaits(self.name, self.status)
+
+        # Send the changes to subscribers
+        self.factory.publish(self.name, self.status)
+
     def log(self, msg, time=None, source=None, type='message'):
         if source is None:
             source = self.name
 
         self.factory.log(msg, time=time, source=source, type=type)
 
+    def pollConfig(self, key):
+        """Polling parameter for this client, either from config file or default one"""
+        client = self.object['clients'].get(self.name) or {}
+        value = client.get(key)
+
+        if value is None:
+            value = getattr(self, '_poll_' + key)
+
+        return value
+
+    def pollStats(self):
+        """Polling statistics for this client"""
+        return {'interval': self._poll_interval, 'rtt': self._poll_rtt,
+                'timeouts': self._poll_timeouts, 'pending': self._poll_sent is not None}
+
     def update(self):
-        if self.name or self.type:
-            self.message('get_status')
+        if not (self.name or self.type):
+            return
+
+        if self.type == 'monitor' and self.name not in self.object['clients']:
+            # Do not poll upstream monitors connected to us
+            return
+
+        now = self.factory._reactor.seconds()
+
+        if self._poll_interval is None:
+            self._poll_interval = self.pollConfig('refresh')
+
+        if self._poll_sent is not None:
+            if now - self._poll_sent < self.pollConfig('timeout'):
+                # Keep at most one outstanding request per client
+                return
+
+            # The reply is lost, slow down the polling of this client
+            self._poll_timeouts += 1
+            self._poll_interval = min(2*self._poll_interval, max(self.pollConfig('refresh_max'), self.pollConfig('refresh')))
+            # Next request goes out after the new interval counted from the moment of timeout
+            self._poll_next = now + self._poll_interval
+            self._poll_late = self._poll_sent
+            self._poll_sent = None
+
+            if self._debug:
+                print("%s: get_status timed out, polling every %g s" % (self.name, self._poll_interval))
+
+        if now >= self._poll_next:
+            self._poll_sent = now
+            self._poll_next = now + self._poll_interval
+            if self.type == 'monitor':
+                # Downstream monitor, request only the changes since previous request
+                self.message('get_status format=delta')
+            else:
+                self.message('get_status')
 
 
 class WSProtocol(SimpleProtocol):
@@ -196,6 +496,143 @@ class MonitorFactory(SimpleFactory):
 
         return status
 
+    @catch
+    def getFlatStatus(self):
+        """Status as a flat dictionary of client.key=value strings, same as in plain status reply"""
+        status = OrderedDict()
+        status['nconnected'] = '%d' % len(self.connections)
+        status['db_status_interval'] = '%g' % self.object['db_status_interval']
+
+        for name in self.object['clients']:
+            c = self.findConnection(name=name)
+            if c:
+                status[name] = '1'
+                for key, value in c.status.items():
+                    status[name + '.' + key] = value
+            else:
+                status[name] = '0'
+
+        return status
+
+    @catch
+    def sendCommand(self, name, string):
+        """Send the command to named client, forwarding it to downstream monitor if necessary"""
+        c = self.findConnection(name=name)
+        if c:
+            c.message(string)
+            return True
+
+        # Name like lab2.cryo-con refers to the client of downstream monitor lab2
+        if '.' in name:
+            prefix, subname = name.split('.', 1)
+            c = self.findConnection(name=prefix, type='monitor')
+            if c:
+                c.message('send ' + subname + ' ' + string)
+                return True
+
+        return False
+
+    @catch
+    def addWait(self, wait):
+        """Register the condition to be waited for, and check it against current status"""
+        if wait.id is None:
+            self.object['nwaits'] = self.object.get('nwaits', 0) + 1
+            wait.id = str(self.object['nwaits'])
+
+        self.object['waits'].setdefault(wait.client, []).append(wait)
+
+        if wait.timeout > 0:
+            wait.timer = self._reactor.callLater(wait.timeout, self.finishWait, wait, 'wait_for_timeout')
+
+        c = self.findConnection(name=wait.client)
+        if c:
+            self.checkWaits(wait.client, c.status)
+
+    @catch
+    def checkWaits(self, client, status):
+        """Check all conditions on given client against its new status"""
+        now = self._reactor.seconds()
+
+        for wait in list(self.object['waits'].get(client, [])):
+            if wait.check(status, now):
+                self.finishWait(wait, 'wait_for_done')
+
+    @catch
+    def finishWait(self, wait, reply):
+        """Send the reply to the waiting peer and forget the condition"""
+        waits = self.object['waits'].get(wait.client, [])
+        if wait not in waits:
+            return
+
+        waits.remove(wait)
+        if not waits:
+            self.object['waits'].pop(wait.client)
+
+        if wait.timer and wait.timer.active():
+            wait.timer.cancel()
+
+        wait.protocol.message('%s id=%s value=%s' % (reply, wait.id, wait.value))
+
+    @catch
+    def cancelWaits(self, protocol, id=None):
+        """Forget the conditions waited for by given peer, either all or with given id"""
+        for client in list(self.object['waits'].keys()):
+            for wait in list(self.object['waits'][client]):
+                if wait.protocol == protocol and (id is None or wait.id == id):
+                    if wait.timer and wait.timer.active():
+                        wait.timer.cancel()
+                    self.object['waits'][client].remove(wait)
+
+            if not self.object['waits'][client]:
+                self.object['waits'].pop(client)
+
+    @catch
+    def subscribe(self, sub):
+        """Register the subscription in the index by client name, and send it current values"""
+        for client in sub.clients:
+            self.object['subscriptions'].setdefault(client, []).append(sub)
+
+        for name in self.object['clients']:
+            c = self.findConnection(name=name)
+            if c and (name in sub.clients or '*' in sub.clients):
+                sub.update(name, c.status, self._reactor)
+
+    @catch
+    def unsubscribe(self, protocol):
+        """Remove all subscriptions of given peer"""
+        for client in list(self.object['subscriptions'].keys()):
+            subs = self.object['subscriptions'][client]
+            for sub in [_ for _ in subs if _.protocol == protocol]:
+                sub.cancel()
+                subs.remove(sub)
+
+            if not subs:
+                self.object['subscriptions'].pop(client)
+
+    @catch
+    def publish(self, client, status):
+        """Pass the new client status to the subscriptions indexed by its name or by wildcard"""
+        index = self.object['subscriptions']
+
+        for sub in index.get(client, []) + index.get('*', []):
+            sub.update(client, status, self._reactor)
+
+    @catch
+    def getPollStats(self, as_dict=False):
+        """Polling statistics for all connected registered clients, flattened as client.key=value"""
+        stats = {}
+
+        for name in self.object['clients']:
+            c = self.findConnection(name=name)
+            if c:
+                if as_dict:
+                    stats[name] = c.pollStats()
+                else:
+                    for key, value in c.pollStats().items():
+                        stats[name + '.' + key] = '%g' % value if type(value) == float else str(value)
+
+        return stats
+
     @catch
     def log(self, msg, time=None, source=None, type='message'):
         """Log the message to both console, web-interface and database, if connected"""
@@ -209,7 +646,7 @@ class MonitorFactory(SimpleFactory):
 
         # DB
         if 'db' in self.object and self.object['db'] is not None:
-            self.object['db'].log(msg, time=time, source=source, type=type)
+            self.object['db'].deferLog(msg, time=time, source=source, type=type).addErrback(lambda failure: failure.printTraceback())
 
         # WebSockets
         if 'ws' in self.object:
@@ -226,6 +663,118 @@ class MonitorFactory(SimpleFactory):
         self.log('Resetting plots', source='monitor', type='info')
         pass
 
+    def connectClient(self, name):
+        """Start the persistent connection to registered client"""
+        c = self.object['clients'][name]
+        self.object['services'][name] = self.connect(c['host'], c['port'])
+
+    def disconnectClient(self, name):
+        """Stop the persistent connection to the client"""
+        service = self.object['services'].pop(name, None)
+        if service is not None:
+            service.stopService()
+
+    @catch
+    def reloadConfig(self):
+        """Re-read the config file and apply the changes, keeping unchanged clients connected"""
+        new = {'clients': OrderedDict(), 'values': {}}
+        for key in ['port', 'http_port', 'name', 'db_host', 'db_path', 'db_status_interval', 'snapshot_dir', 'snapshot_interval']:
+            new[key] = self.object[key]
+
+        try:
+            loaded = loadINI(self.object['config'], new)
+        except Exception as e:
+            loaded = False
+            print("Error parsing %s: %s" % (self.object['config'], e))
+
+        if not loaded:
+            # Empty, partially written or broken file, keep current config and clients
+            self.log('Config %s is empty or invalid, not reloaded' % self.object['config'], type='warning')
+            return
+
+        # Options from command line take precedence over the config file
+        new.update(self.object['cmdline_options'])
+
+        # Clients from command line take precedence over the config file
+        for name, (host, port) in self.object['cmdline_clients'].items():
+            if name in new['clients']:
+                new['clients'][name]['host'] = host
+                new['clients'][name]['port'] = port
+            else:
+                new['clients'][name] = self.object['clients'][name]
+                new['values'][name] = self.object['values'].get(name, {})
+
+        clients = self.object['clients']
+
+        for name in list(clients.keys()):
+            if name not in new['clients']:
+                self.disconnectClient(name)
+                self.log('Client %s removed' % name, type='info')
+
+        for name, c in new['clients'].items():
+            if name not in clients:
+                self.log('Client %s added' % name, type='info')
+            elif (c['host'], c['port']) != (clients[name]['host'], clients[name]['port']):
+                self.disconnectClient(name)
+                self.log('Client %s moved to %s:%d' % (name, c['host'], c['port']), type='info')
+
+        # Keep the history of unchanged variables, resizing it if necessary
+        values = self.object['values']
+        for name in list(values.keys()):
+            if name not in new['values']:
+                values.pop(name)
+
+        for name, newvalues in new['values'].items():
+            oldvalues = values.get(name, {})
+            length = max([len(_) for _ in oldvalues.values()] + [0])
+            history = new['clients'][name].get('history') or MonitorProtocol._poll_history
+
+            for key in list(oldvalues.keys()):
+                if key not in newvalues:
+                    oldvalues.pop(key)
+
+            # Trim first, so that new variables are padded to the same length as the trimmed ones
+            length = min(length, history)
+
+            for key in newvalues:
+                if key not in oldvalues:
+                    # New variable, pad it to the same length as others
+                    oldvalues[key] = [None]*length
+                elif len(oldvalues[key]) > length:
+                    del oldvalues[key][:-length or None]
+                elif len(oldvalues[key]) < length:
+                    oldvalues[key][:0] = [None]*(length - len(oldvalues[key]))
+
+            values[name] = oldvalues
+
+        # Update client descriptions in place, as they are shared with connections
+        clients.clear()
+        clients.update(new['clients'])
+
+        for name in clients:
+            if name not in self.object['services']:
+                self.connectClient(name)
+
+        for key in ['db_status_interval', 'snapshot_interval']:
+            self.object[key] = new[key]
+
+        for key in ['port', 'http_port', 'name', 'db_host', 'db_path', 'snapshot_dir']:
+            if new[key] != self.object[key]:
+                self.log('Change of %s requires restart' % key, type='warning')
+
+        self.log('Config reloaded from %s' % self.object['config'], type='info')
+
+    @catch
+    def watchConfig(self):
+        """Reload the config file if it was modified"""
+        mtime = os.path.getmtime(self.object['config'])
+
+        if self.object.get('config_mtime') is None:
+            self.object['config_mtime'] = mtime
+        elif mtime != self.object['config_mtime']:
+            self.object['config_mtime'] = mtime
+            self.reloadConfig()
+
 
 class CmdlineProtocol(LineReceiver):
     delimiter = os.linesep.encode('ascii')
@@ -262,13 +811,17 @@ class CmdlineProtocol(LineReceiver):
             self.message("Number of registered clients: %d" % len(self.object['clients']))
             for name, c in self.object['clients'].items():
                 conn = self.factory.findConnection(name=c['name'])
-                self.message("  %s:%s name:%s connected:%s" % (c['host'], c['port'], c['name'], conn != None))
+                if conn:
+                    stats = conn.pollStats()
+                    rtt = '%.3f' % stats['rtt'] if stats['rtt'] is not None else '-'
+                    self.message("  %s:%s name:%s connected:True interval:%g rtt:%s timeouts:%d" %
+                                 (c['host'], c['port'], c['name'], stats['interval'] or 0, rtt, stats['timeouts']))
+                else:
+                    self.message("  %s:%s name:%s connected:False" % (c['host'], c['port'], c['name']))
             self.message()
 
         elif cmd.name == 'send' and cmd.chunks[1]:
-            c = self.factory.findConnection(name=cmd.chunks[1])
-            if c:
-                c.message(" ".join(cmd.chunks[2:]))
+            self.factory.sendCommand(cmd.chunks[1], " ".join(cmd.chunks[2:]))
 
         elif cmd.name == 'get_status':
             self.message(self.factory.getStatus())
@@ -281,6 +834,9 @@ class CmdlineProtocol(LineReceiver):
         elif cmd.name == 'reset_plots':
             self.factory.reset_plots()
 
+        elif cmd.name == 'reload_config':
+            self.factory.reloadConfig()
+
         self.transport.write(b'### ')
 
 
@@ -290,6 +846,13 @@ def serve_json(request, **kwargs):
 
 
 def make_plot(file, obj, client_name, plot_name, size=800):
+    # Matplotlib and numpy are slow to import, and are needed only for serving the plots
+    import numpy as np
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    from matplotlib.figure import Figure
+    from matplotlib.dates import DateFormatter
+    from matplotlib.ticker import MaxNLocator, NullLocator
+
     plot = obj['clients'][client_name]['plots'][plot_name]
     values = obj['values'][client_name]
 
@@ -366,7 +929,8 @@ class WebMonitor(Resource):
         if q.path == b'/monitor/status':
             return serve_json(request,
                               clients=self.object['clients'],
-                              status=self.factory.getStatus(as_dict=True)).encode('ascii')
+                              status=self.factory.getStatus(as_dict=True),
+                              poll=self.factory.getPollStats(as_dict=True)).encode('ascii')
         # /monitor/plots/{client}/{name}
         elif qs[1] == 'monitor' and qs[2] == 'plot' and len(qs) > 4:
             s = BytesIO()
@@ -383,9 +947,7 @@ class WebMonitor(Resource):
                 self.factory._reactor.stop()
 
             elif cmd.name == 'send' and cmd.chunks[1]:
-                c = self.factory.findConnection(name=cmd.chunks[1])
-                if c:
-                    c.message(" ".join(cmd.chunks[2:]))
+                self.factory.sendCommand(cmd.chunks[1], " ".join(cmd.chunks[2:]))
 
             elif (cmd.name == 'broadcast' or cmd.name == 'send_all'):
                 self.factory.messageAll(" ".join(cmd.chunks[1:]))
@@ -403,12 +965,74 @@ class WebMonitor(Resource):
             elif cmd.name == 'reset_plots':
                 self.factory.reset_plots()
 
+            elif cmd.name == 'reload_config':
+                self.factory.reloadConfig()
+
             return serve_json(request).encode('ascii')
 
         else:
             return q.path
 
 
+@catch
+def saveHistory(dirname, obj):
+    """Store the history of plotted values as a set of .npy files, one per variable"""
+    import numpy as np
+
+    for client, values in obj['values'].items():
+        path = os.path.join(dirname, client)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name, value in values.items():
+            if name == 'time':
+                array = np.array(value, dtype='datetime64[us]')
+            else:
+                try:
+                    # None values will become NaNs
+                    array = np.array(value, dtype=np.float64)
+                except (ValueError, TypeError):
+                    # Non-numerical values are stored as strings
+                    array = np.array([str(_) for _ in value], dtype=np.str_)
+
+            filename = os.path.join(path, name + '.npy')
+
+            # Write to temporary file first so that the snapshot is never left half-written
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(filename + '.tmp', filename)
+
+
+@catch
+def loadHistory(dirname, obj):
+    """Restore the history of plotted values stored by saveHistory()"""
+    import numpy as np
+
+    for client, values in obj['values'].items():
+        arrays = {}
+
+        for name in values:
+            filename = os.path.join(dirname, client, name + '.npy')
+            if os.path.exists(filename):
+                arrays[name] = np.load(filename, mmap_mode='r')
+
+        lengths = set(len(_) for _ in arrays.values())
+        if len(lengths) != 1:
+            # Either nothing is stored, or the snapshot is inconsistent
+            continue
+
+        length = lengths.pop()
+
+        for name in values:
+            if name in arrays:
+                values[name] = arrays[name].tolist()
+            else:
+                # Variable added to the plots after the snapshot was made
+                values[name] = [None]*length
+
+        print("Restored %d points of %s history from %s" % (length, client, dirname))
+
+
 def loadINI(filename, obj):
     # We use ConfigObj library, docs: http://configobj.readthedocs.io/en/latest/index.html
     from configobj import ConfigObj, Section  # apt-get install python-configobj
@@ -420,7 +1044,10 @@ def loadINI(filename, obj):
     http_port = integer(min=0,max=65535,default=%d)
     name = string(default=%s)
     db_host = string(default=%s)
+    db_path = string(default=%s)
     db_status_interval = float(min=0, max=3600, default=%g)
+    snapshot_dir = string(default=%s)
+    snapshot_interval = float(min=0, default=%g)
 
     [__many__]
     enabled = boolean(default=True)
@@ -428,6 +1055,10 @@ def loadINI(filename, obj):
     host = string(default=localhost)
     description = string(default=None)
     template = string(default=default.html)
+    refresh = float(min=0, default=None)
+    timeout = float(min=0, default=None)
+    refresh_max = float(min=0, default=None)
+    history = integer(min=10, default=None)
 
     [[plots]]
     [[[__many__]]]
@@ -439,11 +1070,15 @@ def loadINI(filename, obj):
     height = integer(min=0,max=2048,default=300)
     xscale = string(default=linear)
     yscale = string(default=linear)
-    ''' % (obj['port'], obj['http_port'], obj['name'], obj['db_host'], obj['db_status_interval'])), list_values=False)
+    ''' % (obj['port'], obj['http_port'], obj['name'], obj['db_host'], obj['db_path'], obj['db_status_interval'],
+           obj['snapshot_dir'], obj['snapshot_interval'])), list_values=False)
 
-    confname = '%s.ini' % posixpath.splitext(__file__)[0]
+    confname = filename
     conf = ConfigObj(confname, configspec=schema)
-    if len(conf):
+    if not len(conf):
+        # Missing or empty file
+        return False
+    else:
         result = conf.validate(Validator())
         if result != True:
             print("Config file failed validation: %s" % confname)
@@ -476,7 +1111,7 @@ def loadINI(filename, obj):
 
             obj['clients'][sname] = client
 
-        for key in ['port', 'http_port', 'name', 'db_host', 'db_status_interval']:
+        for key in ['port', 'http_port', 'name', 'db_host', 'db_path', 'db_status_interval', 'snapshot_dir', 'snapshot_interval']:
             obj[key] = conf.get(key)
 
     # print obj
@@ -489,11 +1124,14 @@ if __name__ == '__main__':
     from optparse import OptionParser
 
     # Object holding actual state and work logic.
-    obj = {'clients': OrderedDict(), 'values': {}, 'port': 7100, 'http_port': 8888, 'db_host': None,
-           'db_status_interval': 60.0, 'name': 'monitor', 'db': None}
+    obj = {'clients': OrderedDict(), 'values': {}, 'port': 7100, 'http_port': 8888, 'db_host': None, 'db_path': None,
+           'db_status_interval': 60.0, 'name': 'monitor', 'db': None,
+           'snapshot_dir': None, 'snapshot_interval': 300.0, 'waits': {}, 'subscriptions': {}, 'services': {},
+           'cmdline_clients': {}, 'cmdline_options': {},
+           'config': '%s.ini' % posixpath.splitext(__file__)[0]}
 
     # First read client config from INI file
-    loadINI('%s.ini' % posixpath.splitext(__file__)[0], obj)
+    loadINI(obj['config'], obj)
 
     # Now parse command-line arguments using values read from config as defaults
     # so that they may be changed at startup time
@@ -501,21 +1139,30 @@ if __name__ == '__main__':
     parser.add_option('-p', '--port', help='Daemon port', action='store', dest='port', type='int', default=obj['port'])
     parser.add_option('-H', '--http-port', help='HTTP server port', action='store', dest='http_port', type='int', default=obj['http_port'])
     parser.add_option('-d', '--db-host', help='Database server host', action='store', dest='db_host', type='string', default=obj['db_host'])
+    parser.add_option('-L', '--db-path', help='Local SQLite database file to use instead of PostgreSQL', action='store', dest='db_path', type='string', default=obj['db_path'])
     parser.add_option('-n', '--name', help='Daemon name', action='store', dest='name', type='string', default=obj['name'])
     parser.add_option('-D', '--debug', help='Debug output', action='store_true', dest='debug', default=False)
     parser.add_option('-s', '--server', help='Act as a TCP and HTTP server', action='store_true', dest='server', default=False)
     parser.add_option('-i', '--interval', help='DB logging status inteval', dest='interval', type='float', default=obj['db_status_interval'])
+    parser.add_option('-S', '--snapshot-dir', help='Directory for plot history snapshots', action='store', dest='snapshot_dir', type='string', default=obj['snapshot_dir'])
+    parser.add_option('-w', '--watch-config', help='Reload the config file when it changes', action='store_true', dest='watch_config', default=False)
     parser.add_option('-a', '--auth-file', help='passwords file', action='store', dest='passwd_file', type='string')  # htpasswd -c -d passwdfile user
 
     (options, args) = parser.parse_args()
 
-    obj['db_status_interval'] = options.interval
+    # Remember the options explicitly set on command line, so that config reloads do not override them
+    for key,dest in [('port', 'port'), ('http_port', 'http_port'), ('name', 'name'), ('db_host', 'db_host'), ('db_path', 'db_path'),
+                     ('db_status_interval', 'interval'), ('snapshot_dir', 'snapshot_dir')]:
+        if getattr(options, dest) != parser.defaults[dest]:
+            obj['cmdline_options'][key] = getattr(options, dest)
+        obj[key] = getattr(options, dest)
 
     # Next parse command line positional args as name=host:port tokens
     for arg in args:
         m = re.match('(([a-zA-Z0-9-_]+)=)?(.*):(\d+)', arg)
         if m:
             name, host, port = m.group(2, 3, 4)
+            obj['cmdline_clients'][name] = (host, int(port))
 
             if name in obj['clients']:
                 obj['clients'][name]['host'] = host
@@ -523,11 +1170,24 @@ if __name__ == '__main__':
             else:
                 obj['clients'][name] = {'host': host, 'port': int(port), 'name': name, 'description': name, 'template': 'default.html', 'plots': None}
 
+    # Restore the plot history saved by previous run, and keep saving it periodically and on exit
+    if options.snapshot_dir:
+        loadHistory(options.snapshot_dir, obj)
+
+        if obj['snapshot_interval'] > 0:
+            LoopingCall(saveHistory, options.snapshot_dir, obj).start(obj['snapshot_interval'], now=False)
+
     # Now we have everything to construct and run the daemon
     daemon = MonitorFactory(MonitorProtocol, obj, name=options.name)
 
-    for name, c in obj['clients'].items():
-        daemon.connect(c['host'], c['port'])
+    if options.snapshot_dir:
+        daemon._reactor.addSystemEventTrigger('before', 'shutdown', saveHistory, options.snapshot_dir, obj)
+
+    for name in obj['clients']:
+        daemon.connectClient(name)
+
+    if options.watch_config:
+        LoopingCall(daemon.watchConfig).start(2.0)
 
     # Simple stdio interface
     stdio.StandardIO(CmdlineProtocol(factory=daemon, object=obj), reactor=daemon._reactor)
@@ -557,8 +1217,24 @@ if __name__ == '__main__':
             obj['ws'] = ws
             root.putChild(b"ws", SockJSResource(ws))
 
-        # Database connection
-        obj['db'] = DB(dbhost=options.db_host)
+        # Database connection, falling back to local storage if PostgreSQL is not available
+        from db import DB
+        from db_local import LocalDB
+
+        if options.db_path:
+            obj['db'] = LocalDB(options.db_path)
+        else:
+            try:
+                obj['db'] = DB(dbhost=options.db_host)
+            except Exception as e:
+                obj['db'] = LocalDB('%s.sqlite' % posixpath.splitext(__file__)[0])
+                print("Cannot connect to PostgreSQL (%s), storing the data to %s" % (e, obj['db'].filename))
+
+        if isinstance(obj['db'], LocalDB):
+            obj['db'].start(daemon._reactor)
+
+        # Wait for the writes still running in threads before closing
+        daemon._reactor.addSystemEventTrigger('before', 'shutdown', obj['db'].deferClose)
         obj['db_status_timestamp'] = datetime.datetime.utcfromtimestamp(0)
 
         print("Listening for incoming HTTP connections on port %d" % options.http_port)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
+import startup_profile
+
 import re
-import numpy as np
+from math import nan
 
 from daemon import SimpleFactory, SimpleProtocol, catch
 
@@ -83,12 +85,12 @@ class Owon_odp6033Protocol(SimpleProtocol):
     @catch
     def connectionLost(self, reason):
         self.object['hw_connected'] = 0
-        self.object['V1'] = np.nan
-        self.object['V2'] = np.nan
-        self.object['V3'] = np.nan
-        self.object['I1'] = np.nan
-        self.object['I2'] = np.nan
-        self.object['I3'] = np.nan
+        self.object['V1'] = nan
+        self.object['V2'] = nan
+        self.object['V3'] = nan
+        self.object['I1'] = nan
+        self.object['I2'] = nan
+        self.object['I3'] = nan
         self.object['O1'] = -1
         self.object['O2'] = -1
         self.object['O3'] = -1
@@ -184,7 +186,7 @@ if __name__ == '__main__':
 
     # Object holding actual state and work logic.
     # May be anything that will be passed by reference - list, dict, object etc
-    obj = {'hw_connected': 0,'V1':np.nan,'V2':np.nan,'V3':np.nan,'I1':np.nan,'I2':np.nan,'I3':np.nan,'O1':-1,'O2':-1,'O3':-1}
+    obj = {'hw_connected': 0,'V1':nan,'V2':nan,'V3':nan,'I1':nan,'I2':nan,'I3':nan,'O1':-1,'O2':-1,'O3':-1}
 
     daemon = SimpleFactory(DaemonProtocol, obj)
     hw = SimpleFactory(Owon_odp6033Protocol, obj)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import startup_profile
+
 import os, sys
-import numpy as np
+import random
 
 from daemon import SimpleFactory, SimpleProtocol
 from command import Command
@@ -23,7 +25,7 @@ class DaemonProtocol(SimpleProtocol):
 
         if cmd.name == 'get_status':
             if self._simulator:
-                self.message('status hw_connected=1 status=0 pressure=%g simulator=1' % (np.random.uniform(1.0, 10.0)))
+                self.message('status hw_connected=1 status=0 pressure=%g simulator=1' % (random.uniform(1.0, 10.0)))
             else:
                 self.message('status hw_connected=%s status=%d pressure=%g' % (self.object['hw_connected'], self.object['status'], self.object['pressure']))
         else:
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import startup_profile
+
 import textwrap
 import pdb
 import argparse
@@ -0,0 +1,79 @@
+"""
+Startup profiling for the daemons. Should be imported before everything else in the entry point script.
+If --profile-startup option is given on command line, it is removed from sys.argv (so that option parsers
+do not see it), the time spent importing every module is recorded, and the breakdown is printed as soon as
+the reactor is running
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import time
+
+try:
+    import builtins
+except ImportError:
+    # Python2
+    import __builtin__ as builtins
+
+_start = time.time()
+
+enabled = False
+
+# Per-import records of (name, self time, cumulative time, nesting depth)
+_records = []
+_stack = []
+_original_import = builtins.__import__
+_scheduled = False
+
+def _timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        # Already imported, nothing to measure
+        return _original_import(name, *args, **kwargs)
+
+    t0 = time.time()
+    _stack.append([0.0]) # Time spent in nested imports
+
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        children = _stack.pop()[0]
+        elapsed = time.time() - t0
+
+        if _stack:
+            _stack[-1][0] += elapsed
+
+        _records.append((name, elapsed - children, elapsed, len(_stack)))
+
+def enable():
+    global enabled
+
+    if not enabled:
+        enabled = True
+        builtins.__import__ = _timed_import
+
+def report(limit=20):
+    """Print the time since startup and the slowest imports"""
+    builtins.__import__ = _original_import
+
+    print("Startup took %.3f s, %.3f s of it in imports" % (time.time() - _start, sum([_[2] for _ in _records if _[3] == 0])))
+
+    print("Slowest top-level imports, cumulative:")
+    for name,self_time,cumulative,depth in sorted([_ for _ in _records if _[3] == 0], key=lambda _: -_[2])[:limit]:
+        print("  %8.3f s  %s" % (cumulative, name))
+
+    print("Slowest modules by their own import time:")
+    for name,self_time,cumulative,depth in sorted(_records, key=lambda _: -_[1])[:limit]:
+        print("  %8.3f s  %s" % (self_time, name))
+
+def schedule(reactor):
+    """Print the report once the reactor is running, if profiling is enabled"""
+    global _scheduled
+
+    if enabled and not _scheduled:
+        _scheduled = True
+        reactor.callWhenRunning(report)
+
+if '--profile-startup' in sys.argv:
+    sys.argv.remove('--profile-startup')
+    enable()
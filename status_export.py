@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import datetime
+
+import numpy as np
+
+# Regular expression for JSON string values convertible to float
+numeric_regex = r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$'
+
+def value_expressions(variables):
+    """SQL expressions for client.key variables from monitor_status snapshots, named v0, v1, ..., as floats with
+    non-numerical and missing values becoming NULLs, and the condition selecting the snapshots containing any of them"""
+    columns = []
+    conditions = []
+
+    for i,var in enumerate(variables):
+        client,key = var.split('.', 1)
+        expr = "(status #> '{%s}' #>> '{%s}')" % (client, key)
+        # Regex is inlined so that the query needs no other parameters
+        columns.append("CASE WHEN %s ~ '%s' THEN %s::float8 END AS v%d" % (expr, numeric_regex, expr, i))
+        conditions.append("%s IS NOT NULL" % expr)
+
+    return ', '.join(columns), '(' + ' OR '.join(conditions) + ')'
+
+
+def export_query(variables):
+    """SQL query extracting given client.key variables from monitor_status snapshots. Time range is passed as two parameters"""
+    columns, condition = value_expressions(variables)
+
+    return 'SELECT time, %s FROM monitor_status WHERE time > %%s AND time <= %%s AND %s ORDER BY time' % (columns, condition)
+
+
+def buckets_query(variables):
+    """SQL query aggregating client.key variables from monitor_status snapshots into time buckets, with min, mean and max
+    of every variable. Parameters are the start time, bucket length in seconds, and the time range"""
+    columns, condition = value_expressions(variables)
+    aggregates = ', '.join(['min(v%d), avg(v%d), max(v%d)' % (_, _, _) for _ in range(len(variables))])
+
+    return '''
+    SELECT floor(extract(epoch from time - %%s)/%%s) AS bucket, %s
+    FROM (SELECT time, %s FROM monitor_status WHERE time > %%s AND time <= %%s AND %s) AS s
+    GROUP BY bucket ORDER BY bucket
+    ''' % (aggregates, columns, condition)
+
+
+def export_chunks(rows_iter, variables):
+    """Convert the chunks of rows from export_query() to the dictionaries of numpy columns, with NaNs for missing values"""
+    for rows in rows_iter:
+        if not len(rows):
+            continue
+
+        columns = list(zip(*rows))
+        chunk = {'time': np.array(columns[0], dtype='datetime64[us]')}
+
+        for i,var in enumerate(variables):
+            chunk[var] = np.array(columns[i + 1], dtype=float)
+
+        yield chunk
+
+
+def cursor_chunks(cur, chunk=100000):
+    """Read the rows from already executed cursor in chunks"""
+    while True:
+        rows = cur.fetchmany(chunk)
+        if not rows:
+            break
+
+        yield rows
+
+
+def write_npz(file, chunks, variables):
+    """Store the columns to compressed numpy archive. The chunks have to be concatenated in memory for it"""
+    names = ['time'] + list(variables)
+    columns = {_: [] for _ in names}
+
+    for chunk in chunks:
+        for name in names:
+            columns[name].append(chunk[name])
+
+    np.savez_compressed(file, **{_: np.concatenate(columns[_]) if columns[_] else np.array([], dtype='datetime64[us]' if _ == 'time' else float)
+                                 for _ in names})
+
+
+def write_parquet(file, chunks, variables):
+    """Store the columns to Parquet file, one row group per chunk"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('time', pa.timestamp('us'))] + [(_, pa.float64()) for _ in variables])
+
+    with pq.ParquetWriter(file, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.table({_.name: chunk[_.name] for _ in schema}, schema=schema))
+
+
+def write_hdf5(file, chunks, variables):
+    """Store the columns to HDF5 file as resizable datasets, time being in microseconds since Unix epoch"""
+    import h5py
+
+    with h5py.File(file, 'w') as f:
+        datasets = {'time': f.create_dataset('time', (0,), dtype='i8', maxshape=(None,), chunks=True)}
+        datasets['time'].attrs['units'] = 'microseconds since 1970-01-01 00:00:00 UTC'
+
+        for var in variables:
+            datasets[var] = f.create_dataset(var, (0,), dtype='f8', maxshape=(None,), chunks=True, fillvalue=np.nan)
+
+        for chunk in chunks:
+            for name,dataset in datasets.items():
+                values = chunk[name].astype('i8') if name == 'time' else chunk[name]
+                size = dataset.shape[0]
+                dataset.resize((size + len(values),))
+                dataset[size:] = values
+
+
+_writers = {'npz': write_npz, 'parquet': write_parquet, 'hdf5': write_hdf5}
+
+# File extensions for the formats
+extensions = {'npz': '.npz', 'parquet': '.parquet', 'hdf5': '.h5'}
+
+def export_formats():
+    """List of formats available with installed libraries"""
+    formats = ['npz']
+
+    for fmt,module in [('parquet', 'pyarrow'), ('hdf5', 'h5py')]:
+        try:
+            __import__(module)
+            formats.append(fmt)
+        except ImportError:
+            pass
+
+    return formats
+
+
+def format_from_filename(filename):
+    ext = os.path.splitext(filename)[1].lower()
+
+    if ext in ['.h5', '.hdf5', '.hdf']:
+        return 'hdf5'
+    elif ext in ['.parquet', '.pq']:
+        return 'parquet'
+    else:
+        return 'npz'
+
+
+def write_export(file, rows_iter, variables, format='npz'):
+    """Write the chunks of rows from export_query() to the file (name or file-like object) of given format"""
+    _writers[format](file, export_chunks(rows_iter, variables), variables)
+
+
+def export_status(db, variables, time1, time2, file, format='npz', chunk=100000):
+    """Stream given client.key variables for the time range from the database to the file of given format"""
+    write_export(file, db.iter_query(export_query(variables), (time1, time2), chunk=chunk), variables, format=format)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    from db import DB
+    from db_admin import parse_time
+
+    parser = OptionParser(usage="usage: %prog [options] client1.key1 client2.key2 ...")
+    parser.add_option('-d', '--db-host', help='Database server host', action='store', dest='db_host', type='string', default='')
+    parser.add_option('-f', '--from', help='Start time, YYYY-MM-DD[ HH:MM:SS]', action='store', dest='time1', type='string', default=None)
+    parser.add_option('-t', '--to', help='End time, YYYY-MM-DD[ HH:MM:SS], default to now', action='store', dest='time2', type='string', default=None)
+    parser.add_option('--hours', help='Number of hours before end time, if start time is not set', action='store', dest='hours', type='float', default=24.0)
+    parser.add_option('-o', '--output', help='Output file, its extension (.npz, .parquet, .h5) sets the format', action='store', dest='output', type='string', default='status.npz')
+    parser.add_option('-F', '--format', help='Output format: npz, parquet or hdf5', action='store', dest='format', type='string', default=None)
+    parser.add_option('-c', '--chunk', help='Number of rows to read at once', action='store', dest='chunk', type='int', default=100000)
+
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.error("Variables to export should be given")
+
+    fmt = options.format or format_from_filename(options.output)
+    if fmt not in export_formats():
+        parser.error("Format %s is not available, supported ones are: %s" % (fmt, ", ".join(export_formats())))
+
+    time2 = parse_time(options.time2) or datetime.datetime.utcnow()
+    time1 = parse_time(options.time1) or time2 - datetime.timedelta(hours=options.hours)
+
+    db = DB(dbhost=options.db_host, readonly=True)
+
+    export_status(db, args, time1, time2, options.output, format=fmt, chunk=options.chunk)
+
+    print("%s: %s - %s exported to %s" % (", ".join(args), time1, time2, options.output))
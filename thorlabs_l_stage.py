@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import startup_profile
+
 from optparse import OptionParser
 from collections import namedtuple
 import struct as st